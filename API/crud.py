@@ -1,12 +1,336 @@
-from sqlalchemy.orm import Session
+from pydantic import ValidationError
+from sqlalchemy import ARRAY, BigInteger, and_, any_, cast, delete, event, exists, func, insert, literal, literal_column, or_, select, text, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased, joinedload
+import API.metrics as metrics
 import API.models as models
 import API.schemas as schemas
-from datetime import date, datetime
+from API.cache import TTLCache
+from API.database import get_setting
+from datetime import date, datetime, timedelta
+import csv
+import io
+import time
 import uuid
 
+STREAM_BATCH_SIZE = 1000
+# NOTIFY channel of the device history change feed, signalled by every write to device_histories
+HISTORY_CHANNEL = 'device_histories'
+# Device columns whose changes are written to the device history, with the event recorded for each
+DEVICE_HISTORY_EVENTS = {
+    'location_id': 'Zmiana lokalizacji urządzenia: {old} -> {new}',
+    'quantity': 'Zmiana ilości sztuk: {old} -> {new}',
+    'returned': 'Zarejestrowano zwrot urządzenia (ID: {device.qr_code})',
+    'status': 'Zmiana statusu urządzenia: {old} -> {new}',
+    'condition': 'Zmiana stanu urządzenia: {old} -> {new}',
+}
+# Every other edit and every new device also write an event, so syncing clients find all changed devices in the history
+DEVICE_EDIT_COLUMNS = ('name', 'serial_number', 'description', 'ean_device_id', 'qr_code')
+DEVICE_EDIT_EVENT = 'Zmiana danych urządzenia: {columns}'
+DEVICE_CREATED_EVENT = 'Dodano urządzenie (ID: {qr_code})'
+# Device columns keying the stock_levels summary
+STOCK_KEY = ('location_id', 'ean_device_id', 'status', 'returned')
+DEVICE_IMPORT_COLUMNS = ('name', 'serial_number', 'description', 'ean_device_id', 'location_id', 'quantity',
+                         'condition', 'status', 'date_added', 'qr_code', 'returned')
+
+# Locations, producers, categories and EAN devices, cached as schemas by id and by natural key.
+# Every write to these tables clears the cache, the TTL bounds staleness caused by other workers
+reference_cache = TTLCache(maxsize=get_setting('cache', 'maxsize', 1024, int), ttl=get_setting('cache', 'ttl', 60.0, float))
+
+EAN_DEVICE_LOAD = (joinedload(models.EAN_Devices.producer), joinedload(models.EAN_Devices.category))
+DEVICE_LOAD = (joinedload(models.Devices.location),
+               joinedload(models.Devices.ean_device).joinedload(models.EAN_Devices.producer),
+               joinedload(models.Devices.ean_device).joinedload(models.EAN_Devices.category))
+DEVICE_HISTORY_LOAD = tuple(joinedload(models.Device_histories.device).options(option) for option in DEVICE_LOAD)
+
+# Columns read for each top level field of the list routes, which select plain tuples instead of ORM objects
+EAN_DEVICE_FIELDS = {
+    'ean_device_id': (models.EAN_Devices.ean_device_id,),
+    'ean': (models.EAN_Devices.ean,),
+    'category': (models.Categories.category_id, models.Categories.name),
+    'producer': (models.Producers.producer_id, models.Producers.name),
+    'model': (models.EAN_Devices.model,),
+}
+DEVICE_FIELDS = {
+    'device_id': (models.Devices.device_id,),
+    'name': (models.Devices.name,),
+    'serial_number': (models.Devices.serial_number,),
+    'description': (models.Devices.description,),
+    'ean_device': sum(EAN_DEVICE_FIELDS.values(), ()),
+    'location': (models.Locations.location_id, models.Locations.name),
+    'quantity': (models.Devices.quantity,),
+    'condition': (models.Devices.condition,),
+    'status': (models.Devices.status,),
+    'date_added': (models.Devices.date_added,),
+    'qr_code': (models.Devices.qr_code,),
+    'returned': (models.Devices.returned,),
+    'version': (models.Devices.version,),
+}
+# Nested documents, built from their columns in the order listed above
+FIELD_DOCUMENTS = {
+    'category': lambda values: {'category_id': values[0], 'name': values[1]},
+    'producer': lambda values: {'producer_id': values[0], 'name': values[1]},
+    'location': lambda values: {'location_id': values[0], 'name': values[1]},
+    'ean_device': lambda values: {'ean_device_id': values[0], 'ean': values[1],
+                                  'category': {'category_id': values[2], 'name': values[3]},
+                                  'producer': {'producer_id': values[4], 'name': values[5]},
+                                  'model': values[6]},
+}
+# Groups of GET /stock/
+STOCK_GROUPS = {
+    'location': DEVICE_FIELDS['location'],
+    'ean_device': DEVICE_FIELDS['ean_device'],
+    'category': EAN_DEVICE_FIELDS['category'],
+    'producer': EAN_DEVICE_FIELDS['producer'],
+    'status': (models.Stock_levels.status,),
+    'returned': (models.Stock_levels.returned,),
+}
+# Sort keys of the list routes, each backed by an index ending in the primary key (see models). Names may be NULL,
+# they sort as empty strings; the other keys are NOT NULL columns
+EAN_DEVICE_SORT_KEYS = {
+    'ean_device_id': models.EAN_Devices.ean_device_id,
+    'ean': models.EAN_Devices.ean,
+    'model': models.EAN_Devices.model,
+}
+DEVICE_SORT_KEYS = {
+    'device_id': models.Devices.device_id,
+    'name': func.coalesce(models.Devices.name, ''),
+    'date_added': models.Devices.date_added,
+    'status': models.Devices.status,
+    'qr_code': models.Devices.qr_code,
+}
+DEVICE_HISTORY_EVENT_COLUMNS = (models.Device_histories.history_id, models.Device_histories.event,
+                                models.Device_histories.device_id, models.Device_histories.date)
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def _keyset(query, key, limit=None, after=None, stream=False, sort=None, descending=False):
+    # Keyset pagination: rows after the "after" cursor, which is the primary key of the last row seen.
+    # Rows are in sort column order with the primary key breaking ties, or in key order
+    order = (key,) if sort is None or sort is key else (sort, key)
+    if after is not None:
+        if len(order) == 1:
+            cursor = after
+        else:
+            # The sort value of the cursor row, read up front: once that row is deleted the cursor has no position
+            cursor = query.session.query(*order).filter(key == after).first()
+            if cursor is None:
+                raise InvalidCursor("Unknown cursor {0}, the row no longer exists".format(after))
+            cursor = tuple_(*cursor)
+        position = tuple_(*order) if len(order) > 1 else key
+        query = query.filter(position < cursor if descending else position > cursor)
+    query = query.order_by(*(column.desc() if descending else column for column in order))
+    if limit is not None:
+        query = query.limit(limit)
+    if stream:
+        # Server-side cursor, rows are fetched in batches while the response is written
+        return query.yield_per(STREAM_BATCH_SIZE)
+    return query.all()
+
+
+def _rows(rows, build, stream=False):
+    # Response rows built straight from SQL tuples, lazily while streaming
+    rows = (build(row) for row in rows)
+    return rows if stream else list(rows)
+
+
+def _projection(columns_by_field, fields):
+    # The columns of the requested fields and a function building the response document from their tuples,
+    # the same document as the schema without validating the trusted database output again
+    columns, spans = [], []
+    for field in fields:
+        spans.append((field, len(columns), len(columns) + len(columns_by_field[field]), FIELD_DOCUMENTS.get(field)))
+        columns.extend(columns_by_field[field])
+
+    def build(row):
+        return {field: document(row[start:end]) if document else row[start] for field, start, end, document in spans}
+    return columns, build
+
+
+def _device_rows_query(db: Session, fields=None):
+    # References are joined only when their fields are selected
+    fields = fields or tuple(DEVICE_FIELDS)
+    columns, build = _projection(DEVICE_FIELDS, fields)
+    query = db.query(*columns).select_from(models.Devices)
+    if 'location' in fields:
+        query = query.outerjoin(models.Devices.location)
+    if 'ean_device' in fields:
+        query = query.outerjoin(models.Devices.ean_device).outerjoin(models.EAN_Devices.category) \
+            .outerjoin(models.EAN_Devices.producer)
+    return query, build
+
+
+def _ean_device_rows_query(db: Session, fields=None):
+    fields = fields or tuple(EAN_DEVICE_FIELDS)
+    columns, build = _projection(EAN_DEVICE_FIELDS, fields)
+    query = db.query(*columns).select_from(models.EAN_Devices)
+    if 'category' in fields:
+        query = query.outerjoin(models.EAN_Devices.category)
+    if 'producer' in fields:
+        query = query.outerjoin(models.EAN_Devices.producer)
+    return query, build
+
+
+def _sort(sort_keys, sort):
+    # "name" sorts ascending, "-name" descending
+    return sort_keys[sort.lstrip('-')], sort.startswith('-')
+
+
+def bump_table_versions(db: Session, tables):
+    # Inside the writing transaction, so a reader never sees new rows under an old version.
+    # Rows are locked in name order, concurrent writers can't deadlock on them
+    if not tables:
+        return
+    statement = pg_insert(models.Table_versions).values([{'table_name': table, 'version': 1} for table in sorted(tables)])
+    db.execute(statement.on_conflict_do_update(index_elements=[models.Table_versions.table_name],
+                                               set_={'version': models.Table_versions.version + 1}))
+    if models.Device_histories.__tablename__ in tables:
+        # Delivered to the listeners when the transaction commits, never for a rollback
+        db.execute(select(func.pg_notify(HISTORY_CHANNEL, '')))
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_flushed_tables(session, flush_context):
+    # ORM writes bump their tables here, Core statements (bulk import, set-based deletes, history inserts) call
+    # bump_table_versions themselves
+    changed = list(session.new) + list(session.deleted) + [obj for obj in session.dirty if session.is_modified(obj)]
+    bump_table_versions(session, {obj.__table__.name for obj in changed})
+
+
+def _add_stock(deltas, values, devices):
+    # Counts a device (devices=1) or removes it (devices=-1) from its stock_levels group
+    key = tuple(values[column] for column in STOCK_KEY)
+    count, quantity = deltas.get(key, (0, 0))
+    deltas[key] = (count + devices, quantity + devices * values['quantity'])
+
+
+def adjust_stock_levels(db: Session, deltas):
+    # One upsert for all changed groups, in key order like bump_table_versions
+    changes = [dict(zip(STOCK_KEY, key), devices=count, quantity=quantity)
+               for key, (count, quantity) in sorted(deltas.items()) if count or quantity]
+    if not changes:
+        return
+    statement = pg_insert(models.Stock_levels).values(changes)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[getattr(models.Stock_levels, column) for column in STOCK_KEY],
+        set_={'devices': models.Stock_levels.devices + statement.excluded.devices,
+              'quantity': models.Stock_levels.quantity + statement.excluded.quantity}))
+
+
+def stock_levels_missing(db: Session):
+    # True for a database created before stock_levels, which then needs a rebuild
+    return db.query(db.query(models.Devices).exists()).scalar() and \
+        not db.query(db.query(models.Stock_levels).exists()).scalar()
+
+
+def rebuild_stock_levels(db: Session):
+    # Recomputes the summary from devices; device writes wait on the share lock until the commit
+    db.execute(text("LOCK TABLE devices IN SHARE MODE"))
+    db.execute(delete(models.Stock_levels))
+    keys = [getattr(models.Devices, column) for column in STOCK_KEY]
+    db.execute(insert(models.Stock_levels).from_select(
+        list(STOCK_KEY) + ['devices', 'quantity'],
+        select(*keys, func.count(), func.coalesce(func.sum(models.Devices.quantity), 0))
+        .where(*(key.isnot(None) for key in keys)).group_by(*keys)))
+    groups = db.query(models.Stock_levels).count()
+    db.commit()
+    return groups
+
+
+def get_stock_levels(db: Session, group_by, location_id=None, ean_device_id=None, category_id=None, producer_id=None,
+                     status=None, returned=None):
+    # Device counts and quantities from the summary table, read in O(groups) rather than O(devices)
+    columns, build = _projection(STOCK_GROUPS, group_by)
+    devices = cast(func.sum(models.Stock_levels.devices), BigInteger)
+    quantity = cast(func.sum(models.Stock_levels.quantity), BigInteger)
+    query = db.query(*columns, devices, quantity).select_from(models.Stock_levels)
+    if 'location' in group_by:
+        query = query.join(models.Locations, models.Locations.location_id == models.Stock_levels.location_id)
+    if {'ean_device', 'category', 'producer'} & set(group_by):
+        query = query.join(models.EAN_Devices, models.EAN_Devices.ean_device_id == models.Stock_levels.ean_device_id)
+        if {'ean_device', 'category'} & set(group_by):
+            query = query.join(models.EAN_Devices.category)
+        if {'ean_device', 'producer'} & set(group_by):
+            query = query.join(models.EAN_Devices.producer)
+    query = query.filter(models.Stock_levels.devices != 0)
+    if location_id is not None:
+        query = query.filter(models.Stock_levels.location_id == location_id)
+    if ean_device_id is not None:
+        query = query.filter(models.Stock_levels.ean_device_id == ean_device_id)
+    if category_id is not None:
+        query = query.filter(models.Stock_levels.ean_device_id.in_(
+            select(models.EAN_Devices.ean_device_id).where(models.EAN_Devices.category_id == category_id)))
+    if producer_id is not None:
+        query = query.filter(models.Stock_levels.ean_device_id.in_(
+            select(models.EAN_Devices.ean_device_id).where(models.EAN_Devices.producer_id == producer_id)))
+    if status:
+        query = query.filter(_any(models.Stock_levels.status, status))
+    if returned is not None:
+        query = query.filter(models.Stock_levels.returned == returned)
+    query = query.group_by(*columns).order_by(*columns)
+    return [dict(build(row), devices=row[-2], quantity=row[-1]) for row in query]
+
+
+def get_table_versions(db: Session, tables):
+    versions = dict(db.query(models.Table_versions.table_name, models.Table_versions.version)
+                    .filter(_any(models.Table_versions.table_name, tables)))
+    return tuple(versions.get(table, 0) for table in tables)
+
+
+def _any(column, values):
+    # column = ANY(:array), a single bind parameter however many values are matched
+    return column == any_(literal(list(values), ARRAY(column.type)))
+
+
+def _reference(db: Session, model, schema, keys, options=(), **criteria):
+    (column, value), = criteria.items()
+    cached = reference_cache.get((model.__tablename__, column, value))
+    if cached is not None:
+        return cached
+    row = db.query(model).filter(getattr(model, column) == value).options(*options).first()
+    if row is None:
+        return None
+    reference = schema.from_orm(row)
+    for key in keys:
+        reference_cache.set((model.__tablename__, key, getattr(reference, key)), reference)
+    return reference
+
+
+def get_location_ref(db: Session, **criteria):
+    return _reference(db, models.Locations, schemas.LocationsSchema, ('location_id', 'name'), **criteria)
+
+
+def get_producer_ref(db: Session, **criteria):
+    return _reference(db, models.Producers, schemas.ProducersSchema, ('producer_id', 'name'), **criteria)
+
+
+def get_category_ref(db: Session, **criteria):
+    return _reference(db, models.Categories, schemas.CategoriesSchema, ('category_id', 'name'), **criteria)
+
+
+def get_ean_device_ref(db: Session, **criteria):
+    return _reference(db, models.EAN_Devices, schemas.EANDevicesSchema, ('ean_device_id', 'ean', 'model'),
+                      EAN_DEVICE_LOAD, **criteria)
+
+
+def _insert_reference(db: Session, model, values):
+    # INSERT ... ON CONFLICT DO NOTHING RETURNING the new row, None when a unique column is taken. The constraint
+    # decides, so of two concurrent creates of the same name exactly one succeeds
+    statement = pg_insert(model).values(values).on_conflict_do_nothing().returning(*model.__table__.columns)
+    row = db.execute(statement).first()
+    if row is not None:
+        bump_table_versions(db, {model.__tablename__})
+    db.commit()
+    reference_cache.clear()
+    return row
+
+
 # Locations
-def get_locations(db: Session):
-    return db.query(models.Locations).all()
+def get_locations(db: Session, limit=None, after=None, stream=False):
+    return _keyset(db.query(models.Locations), models.Locations.location_id, limit, after, stream)
 
 
 def get_location_by_name(db: Session, name: str):
@@ -18,17 +342,14 @@ def get_location_by_id(db: Session, location_id: int):
 
 
 def create_location(db: Session, location: schemas.LocationsSchema):
-    db_location = models.Locations(name=location.name)
-    db.add(db_location)
-    db.commit()
-    db.refresh(db_location)
-    return db_location
+    return _insert_reference(db, models.Locations, {'name': location.name})
 
 
 def update_location_by_name(db: Session, name: str, location: schemas.LocationsSchema):
     n_location = db.query(models.Locations).filter(models.Locations.name == name).first()
     n_location.name = location.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_location)
     return n_location
 
@@ -37,6 +358,7 @@ def update_location_by_id(db: Session, location_id: int, location: schemas.Locat
     n_location = db.query(models.Locations).filter(models.Locations.location_id == location_id).first()
     n_location.name = location.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_location)
     return n_location
 
@@ -45,6 +367,7 @@ def delete_location_by_name(db: Session, name: str):
     db_location = db.query(models.Locations).filter(models.Locations.name == name).first()
     db.delete(db_location)
     db.commit()
+    reference_cache.clear()
     return db_location
 
 
@@ -52,11 +375,12 @@ def delete_location_by_id(db: Session, location_id: int):
     db_location = db.query(models.Locations).filter(models.Locations.location_id == location_id).first()
     db.delete(db_location)
     db.commit()
+    reference_cache.clear()
     return db_location
 
 # Producers
-def get_producers(db: Session):
-    return db.query(models.Producers).all()
+def get_producers(db: Session, limit=None, after=None, stream=False):
+    return _keyset(db.query(models.Producers), models.Producers.producer_id, limit, after, stream)
 
 
 def get_producer_by_name(db: Session, name: str):
@@ -68,17 +392,14 @@ def get_producer_by_id(db: Session, producer_id: int):
 
 
 def create_producer(db: Session, producer: schemas.ProducersSchema):
-    db_producer = models.Producers(name=producer.name)
-    db.add(db_producer)
-    db.commit()
-    db.refresh(db_producer)
-    return db_producer
+    return _insert_reference(db, models.Producers, {'name': producer.name})
 
 
 def update_producer_by_name(db: Session, name: str, producer: schemas.ProducersSchema):
     n_producer = db.query(models.Producers).filter(models.Producers.name == name).first()
     n_producer.name = producer.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_producer)
     return n_producer
 
@@ -87,6 +408,7 @@ def update_producer_by_id(db: Session, producer_id: int, producer: schemas.Produ
     n_producer = db.query(models.Producers).filter(models.Producers.producer_id == producer_id).first()
     n_producer.name = producer.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_producer)
     return n_producer
 
@@ -95,6 +417,7 @@ def delete_producer_by_name(db: Session, name: str):
     db_producer = db.query(models.Producers).filter(models.Producers.name == name).first()
     db.delete(db_producer)
     db.commit()
+    reference_cache.clear()
     return db_producer
 
 
@@ -102,11 +425,12 @@ def delete_producer_by_id(db: Session, producer_id: int):
     db_producer = db.query(models.Producers).filter(models.Producers.producer_id == producer_id).first()
     db.delete(db_producer)
     db.commit()
+    reference_cache.clear()
     return db_producer
 
 # Categories
-def get_categories(db: Session):
-    return db.query(models.Categories).all()
+def get_categories(db: Session, limit=None, after=None, stream=False):
+    return _keyset(db.query(models.Categories), models.Categories.category_id, limit, after, stream)
 
 
 def get_category_by_name(db: Session, name: str):
@@ -118,17 +442,14 @@ def get_category_by_id(db: Session, category_id: int):
 
 
 def create_category(db: Session, category: schemas.CategoriesSchema):
-    db_category = models.Categories(name=category.name)
-    db.add(db_category)
-    db.commit()
-    db.refresh(db_category)
-    return db_category
+    return _insert_reference(db, models.Categories, {'name': category.name})
 
 
 def update_category_by_name(db: Session, name: str, category: schemas.CategoriesSchema):
     n_category = db.query(models.Categories).filter(models.Categories.name == name).first()
     n_category.name = category.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_category)
     return n_category
 
@@ -137,6 +458,7 @@ def update_category_by_id(db: Session, category_id: int, category: schemas.Categ
     n_category = db.query(models.Categories).filter(models.Categories.category_id == category_id).first()
     n_category.name = category.name
     db.commit()
+    reference_cache.clear()
     db.refresh(n_category)
     return n_category
 
@@ -145,6 +467,7 @@ def delete_category_by_name(db: Session, name: str):
     db_category = db.query(models.Categories).filter(models.Categories.name == name).first()
     db.delete(db_category)
     db.commit()
+    reference_cache.clear()
     return db_category
 
 
@@ -152,216 +475,559 @@ def delete_category_by_id(db: Session, category_id: int):
     db_category = db.query(models.Categories).filter(models.Categories.category_id == category_id).first()
     db.delete(db_category)
     db.commit()
+    reference_cache.clear()
     return db_category
 
 # EAN Devices
 
-def get_ean_devices(db: Session, category_name=None, producer_name=None):
+def _category_ids(name):
+    return select(models.Categories.category_id).where(models.Categories.name == name).scalar_subquery()
+
+def _producer_ids(name):
+    return select(models.Producers.producer_id).where(models.Producers.name == name).scalar_subquery()
+
+def get_ean_devices(db: Session, category_name=None, producer_name=None, category_id=None, producer_id=None, model=None,
+                    fields=None, sort='ean_device_id', limit=None, after=None, stream=False):
+    # Rows as dicts shaped like EANDevicesSchema, or holding only the requested fields. Filters combine with AND
+    query, build = _ean_device_rows_query(db, fields)
     if category_name is not None:
-        return db.query(models.EAN_Devices).join(models.Categories).filter(models.Categories.name == category_name).all()
+        query = query.filter(models.EAN_Devices.category_id == _category_ids(category_name))
     if producer_name is not None:
-        return db.query(models.EAN_Devices).join(models.Producers).filter(models.Producers.name == producer_name).all()
-    return db.query(models.EAN_Devices).all()
+        query = query.filter(models.EAN_Devices.producer_id == _producer_ids(producer_name))
+    if category_id is not None:
+        query = query.filter(models.EAN_Devices.category_id == category_id)
+    if producer_id is not None:
+        query = query.filter(models.EAN_Devices.producer_id == producer_id)
+    if model is not None:
+        query = query.filter(models.EAN_Devices.model == model)
+    sort, descending = _sort(EAN_DEVICE_SORT_KEYS, sort)
+    return _rows(_keyset(query, models.EAN_Devices.ean_device_id, limit, after, stream, sort, descending), build, stream)
 
 def get_ean_device_by_model(db: Session, model: str):
-    return db.query(models.EAN_Devices).filter(models.EAN_Devices.model == model).first()
+    return db.query(models.EAN_Devices).filter(models.EAN_Devices.model == model).options(*EAN_DEVICE_LOAD).first()
 
 def get_ean_device_by_id(db: Session, ean_device_id: int):
-    return db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).first()
+    return db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).options(*EAN_DEVICE_LOAD).first()
 
 def get_device_by_ean_code(db: Session, ean_code: str):
-    return db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_code).first()
+    return db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_code).options(*EAN_DEVICE_LOAD).first()
 
 def create_ean_device_by_name(db: Session, ean_device: schemas.EANDevicesSchema):
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
-    db_ean_device = models.EAN_Devices(ean=ean_device.ean, category=category, producer=producer,
-                               model=ean_device.model)
-    db.add(db_ean_device)
-    db.commit()
-    db.refresh(db_ean_device)
-    return db_ean_device
+    category = get_category_ref(db, name=ean_device.category.name)
+    producer = get_producer_ref(db, name=ean_device.producer.name)
+    row = _insert_reference(db, models.EAN_Devices, {'ean': ean_device.ean, 'category_id': category.category_id,
+                                                     'producer_id': producer.producer_id, 'model': ean_device.model})
+    return get_ean_device_by_id(db, row.ean_device_id) if row is not None else None
 
 def create_ean_device_by_id(db: Session, ean_device: schemas.EANDevicesSchema):
-    category = db.query(models.Categories).filter(models.Categories.category_id == ean_device.category.category_id).first()
-    producer = db.query(models.Producers).filter(models.Producers.producer_id == ean_device.producer.producer_id).first()
-    db_ean_device = models.EAN_Devices(ean=ean_device.ean, category=category, producer=producer,
-                               model=ean_device.model)
-    db.add(db_ean_device)
-    db.commit()
-    db.refresh(db_ean_device)
-    return db_ean_device
+    category = get_category_ref(db, category_id=ean_device.category.category_id)
+    producer = get_producer_ref(db, producer_id=ean_device.producer.producer_id)
+    row = _insert_reference(db, models.EAN_Devices, {'ean': ean_device.ean, 'category_id': category.category_id,
+                                                     'producer_id': producer.producer_id, 'model': ean_device.model})
+    return get_ean_device_by_id(db, row.ean_device_id) if row is not None else None
 
 def update_ean_device_by_ean(db: Session, ean: str, ean_device: schemas.EANDevicesSchema):
     n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean).first()
     n_ean_device.ean = ean_device.ean
 
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
-    n_ean_device.category = category
-
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
-    n_ean_device.producer = producer
+    n_ean_device.category_id = get_category_ref(db, name=ean_device.category.name).category_id
+    n_ean_device.producer_id = get_producer_ref(db, name=ean_device.producer.name).producer_id
     n_ean_device.model = ean_device.model
 
     db.commit()
-    db.refresh(n_ean_device)
-    return n_ean_device
+    reference_cache.clear()
+    return get_ean_device_by_id(db, n_ean_device.ean_device_id)
 
 
 def update_ean_device_by_id(db: Session, ean_device_id: int, ean_device: schemas.EANDevicesSchema):
     n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).first()
     n_ean_device.ean = ean_device.ean
 
-    category = db.query(models.Categories).filter(models.Categories.category_id == ean_device.category.category_id).first()
-    n_ean_device.category = category
-
-    producer = db.query(models.Producers).filter(models.Producers.producer_id == ean_device.producer.producer_id).first()
-    n_ean_device.producer = producer
+    n_ean_device.category_id = get_category_ref(db, category_id=ean_device.category.category_id).category_id
+    n_ean_device.producer_id = get_producer_ref(db, producer_id=ean_device.producer.producer_id).producer_id
     n_ean_device.model = ean_device.model
 
     db.commit()
-    db.refresh(n_ean_device)
-    return n_ean_device
+    reference_cache.clear()
+    return get_ean_device_by_id(db, n_ean_device.ean_device_id)
 
 def update_ean_device_by_id_name(db: Session, ean_device_id: int, ean_device: schemas.EANDevicesSchema):
     n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).first()
     n_ean_device.ean = ean_device.ean
 
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
-    n_ean_device.category = category
-
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
-    n_ean_device.producer = producer
+    n_ean_device.category_id = get_category_ref(db, name=ean_device.category.name).category_id
+    n_ean_device.producer_id = get_producer_ref(db, name=ean_device.producer.name).producer_id
     n_ean_device.model = ean_device.model
 
     db.commit()
-    db.refresh(n_ean_device)
-    return n_ean_device
+    reference_cache.clear()
+    return get_ean_device_by_id(db, n_ean_device.ean_device_id)
 
 def delete_ean_device_by_ean(db: Session, ean: str):
-    db_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean).first()
+    db_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean).options(*EAN_DEVICE_LOAD).first()
     db.delete(db_ean_device)
     db.commit()
+    reference_cache.clear()
     return db_ean_device
 
 
 def delete_ean_device_by_id(db: Session, ean_device_id: int):
-    db_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).first()
+    db_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == ean_device_id).options(*EAN_DEVICE_LOAD).first()
     db.delete(db_ean_device)
     db.commit()
+    reference_cache.clear()
     return db_ean_device
 
 # Devices
 
-def get_devices(db: Session, location_name=None, ean_code=None):
+def get_devices(db: Session, location_name=None, ean_code=None, location_id=None, ean_device_id=None, category_name=None,
+                producer_name=None, status=None, condition=None, returned=None, date_from=None, date_to=None,
+                fields=None, sort='device_id', limit=None, after=None, stream=False):
+    # Rows as dicts shaped like DevicesSchema, or holding only the requested fields. Filters combine with AND,
+    # status and condition match any of the given values
+    query, build = _device_rows_query(db, fields)
     if location_name is not None:
-        return db.query(models.Devices).join(models.Locations).filter(models.Locations.name == location_name).all()
+        query = query.filter(models.Devices.location_id == select(models.Locations.location_id)
+                             .where(models.Locations.name == location_name).scalar_subquery())
     if ean_code is not None:
-        return db.query(models.Devices).join(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_code).all()
-    return db.query(models.Devices).all()
+        query = query.filter(models.Devices.ean_device_id == select(models.EAN_Devices.ean_device_id)
+                             .where(models.EAN_Devices.ean == ean_code).scalar_subquery())
+    if location_id is not None:
+        query = query.filter(models.Devices.location_id == location_id)
+    if ean_device_id is not None:
+        query = query.filter(models.Devices.ean_device_id == ean_device_id)
+    if category_name is not None:
+        query = query.filter(models.Devices.ean_device_id.in_(select(models.EAN_Devices.ean_device_id)
+                                                              .where(models.EAN_Devices.category_id == _category_ids(category_name))))
+    if producer_name is not None:
+        query = query.filter(models.Devices.ean_device_id.in_(select(models.EAN_Devices.ean_device_id)
+                                                              .where(models.EAN_Devices.producer_id == _producer_ids(producer_name))))
+    if status:
+        query = query.filter(_any(models.Devices.status, status))
+    if condition:
+        query = query.filter(_any(models.Devices.condition, condition))
+    if returned is not None:
+        query = query.filter(models.Devices.returned == returned)
+    if date_from is not None:
+        query = query.filter(models.Devices.date_added >= date_from)
+    if date_to is not None:
+        query = query.filter(models.Devices.date_added <= date_to)
+    sort, descending = _sort(DEVICE_SORT_KEYS, sort)
+    return _rows(_keyset(query, models.Devices.device_id, limit, after, stream, sort, descending), build, stream)
 
 def get_device_by_name(db: Session, name: str):
-    return db.query(models.Devices).filter(models.Devices.name == name).first()
+    return db.query(models.Devices).filter(models.Devices.name == name).options(*DEVICE_LOAD).first()
 
 def get_device_by_sn(db: Session, serial_number: str):
-    return db.query(models.Devices).filter(models.Devices.serial_number == serial_number).first()
+    return db.query(models.Devices).filter(models.Devices.serial_number == serial_number).options(*DEVICE_LOAD).first()
 
 def get_device_by_id(db: Session, device_id: int):
-    return db.query(models.Devices).filter(models.Devices.device_id == device_id).first()
+    return db.query(models.Devices).filter(models.Devices.device_id == device_id).options(*DEVICE_LOAD).first()
 
 def get_device_by_qr_code(db: Session, qr_code: str):
-    return db.query(models.Devices).filter(models.Devices.qr_code == qr_code).first()
+    return db.query(models.Devices).filter(models.Devices.qr_code == qr_code).options(*DEVICE_LOAD).first()
 
 def create_device_by_name(db: Session, device: schemas.DevicesSchema):
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == device.ean_device.ean).first()
-    location = db.query(models.Locations).filter(models.Locations.name == device.location.name).first()
-    db_device = models.Devices(name=device.name, serial_number=device.serial_number,
-                               description=device.description, ean_device=ean_device,
-                               location=location, quantity=device.quantity, condition=device.condition, status=device.status, date_added=date.today(),
-                               qr_code=device.qr_code, returned=device.returned)
-    # qr_code = str(uuid.uuid4()))
-    db.add(db_device)
-    db.commit()
-    db.refresh(db_device)
-    return db_device
+    # None when a device with the name, QR code or serial number exists
+    ean_device = get_ean_device_ref(db, ean=device.ean_device.ean)
+    location = get_location_ref(db, name=device.location.name)
+    return _insert_device(db, device, ean_device.ean_device_id, location.location_id,
+                          duplicate=models.Devices.name == device.name)
 
 def create_device_by_id(db: Session, device: schemas.DevicesSchema):
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == device.ean_device.ean_device_id).first()
-    location = db.query(models.Locations).filter(models.Locations.location_id == device.location.location_id).first()
-    db_device = models.Devices(name=device.name, serial_number=device.serial_number,
-                               description=device.description, ean_device=ean_device,
-                               location=location, quantity=device.quantity, condition=device.condition, status=device.status, date_added=date.today(),
-                               qr_code=device.qr_code, returned=device.returned)
-    db.add(db_device)
+    # None when a device with the id, QR code or serial number exists
+    ean_device = get_ean_device_ref(db, ean_device_id=device.ean_device.ean_device_id)
+    location = get_location_ref(db, location_id=device.location.location_id)
+    duplicate = models.Devices.device_id == device.device_id if device.device_id is not None else None
+    return _insert_device(db, device, ean_device.ean_device_id, location.location_id, duplicate)
+
+def _insert_device(db: Session, device: schemas.DevicesSchema, ean_device_id, location_id, duplicate=None):
+    # One statement inserts the device and its creation event. ON CONFLICT DO NOTHING skips devices whose QR code or
+    # serial number is taken, also by a concurrent create; duplicate is a condition no constraint enforces
+    values = dict(name=device.name, serial_number=device.serial_number, description=device.description,
+                  ean_device_id=ean_device_id, location_id=location_id, quantity=device.quantity,
+                  condition=device.condition, status=device.status, date_added=date.today(), qr_code=device.qr_code,
+                  returned=device.returned)
+    source = select(*(literal(value, getattr(models.Devices, column).type) for column, value in values.items()))
+    if duplicate is not None:
+        source = source.where(~exists().where(duplicate))
+    created = pg_insert(models.Devices).from_select(list(values), source).on_conflict_do_nothing() \
+        .returning(models.Devices.device_id).cte('created')
+    event = DEVICE_CREATED_EVENT.format(qr_code=device.qr_code)
+    statement = insert(models.Device_histories).from_select(
+        ['event', 'device_id', 'date'], select(literal(event), created.c.device_id, literal(datetime.now()))) \
+        .returning(models.Device_histories.device_id).add_cte(created)
+    device_id = db.execute(statement).scalar()
+    if device_id is None:
+        db.rollback()
+        return None
+    stock = {}
+    _add_stock(stock, values, 1)
+    adjust_stock_levels(db, stock)
+    bump_table_versions(db, {models.Devices.__tablename__, models.Device_histories.__tablename__})
     db.commit()
-    db.refresh(db_device)
-    return db_device
-
-def update_device_by_name(db: Session, name: str, device: schemas.DevicesSchema):
-    n_device = db.query(models.Devices).filter(models.Devices.name == name).first()
-    n_device.name = device.name
-    n_device.serial_number = device.serial_number
-    n_device.description = device.description
-
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == device.ean_device.ean).first()
-    n_device.ean_device = ean_device
-    location = db.query(models.Locations).filter(models.Locations.name == device.location.name).first()
-    n_device.location = location
-
-    n_device.quantity = device.quantity
-    n_device.condition = device.condition
-    n_device.status = device.status
-    n_device.date_added = n_device.date_added
-    n_device.qr_code = device.qr_code
-    n_device.returned = device.returned
+    return get_device_by_id(db, device_id)
+
+def create_devices_bulk(db: Session, rows):
+    results = []
+    devices = []
+    for number, row in enumerate(rows, start=1):
+        try:
+            devices.append((number, schemas.DeviceImportSchema.parse_obj(row)))
+        except ValidationError as error:
+            detail = '; '.join('{0}: {1}'.format('.'.join(map(str, e['loc'])), e['msg']) for e in error.errors())
+            results.append(schemas.DeviceImportResultSchema(row=number, error=detail))
+
+    # References and duplicates are resolved for the whole batch, one query each
+    ean_devices, locations, stock = {}, {}, {}
+    ean_codes = {d.ean for _, d in devices if d.ean is not None}
+    ean_device_ids = {d.ean_device_id for _, d in devices if d.ean_device_id is not None}
+    if ean_codes or ean_device_ids:
+        for ean_device_id, ean in db.query(models.EAN_Devices.ean_device_id, models.EAN_Devices.ean).filter(
+                or_(_any(models.EAN_Devices.ean, ean_codes), _any(models.EAN_Devices.ean_device_id, ean_device_ids))):
+            ean_devices[('id', ean_device_id)] = ean_devices[('ean', ean)] = ean_device_id
+    location_names = {d.location for _, d in devices if d.location is not None}
+    location_ids = {d.location_id for _, d in devices if d.location_id is not None}
+    if location_names or location_ids:
+        for location_id, name in db.query(models.Locations.location_id, models.Locations.name).filter(
+                or_(_any(models.Locations.name, location_names), _any(models.Locations.location_id, location_ids))):
+            locations[('id', location_id)] = locations[('name', name)] = location_id
+    qr_codes = {d.qr_code for _, d in devices}
+    serial_numbers = {d.serial_number for _, d in devices if d.serial_number != ""}
+    taken_qr_codes, taken_serial_numbers = set(), set()
+    if qr_codes:
+        # One index lookup per key joined with UNION ALL; an OR of the two ANYs is planned as a sequential scan
+        # comparing every device against both arrays
+        taken = db.query(models.Devices.qr_code, models.Devices.serial_number).filter(_any(models.Devices.qr_code, qr_codes))
+        if serial_numbers:
+            taken = taken.union_all(db.query(models.Devices.qr_code, models.Devices.serial_number)
+                                    .filter(_any(models.Devices.serial_number, serial_numbers)))
+        for qr_code, serial_number in taken:
+            taken_qr_codes.add(qr_code)
+            taken_serial_numbers.add(serial_number)
+
+    values, row_numbers = [], {}
+    for number, device in devices:
+        if device.ean_device_id is not None:
+            ean_device_id = ean_devices.get(('id', device.ean_device_id))
+        else:
+            ean_device_id = ean_devices.get(('ean', device.ean))
+        if device.location_id is not None:
+            location_id = locations.get(('id', device.location_id))
+        else:
+            location_id = locations.get(('name', device.location))
+        error = None
+        if ean_device_id is None:
+            error = "EAN Device doesn't exist"
+        elif location_id is None:
+            error = "Location doesn't exist"
+        elif device.qr_code in taken_qr_codes:
+            error = "Device with this QR code already exists"
+        elif device.serial_number != "" and device.serial_number in taken_serial_numbers:
+            error = "Device with this serial number already exists"
+        if error is not None:
+            results.append(schemas.DeviceImportResultSchema(row=number, qr_code=device.qr_code, error=error))
+            continue
+        taken_qr_codes.add(device.qr_code)
+        taken_serial_numbers.add(device.serial_number)
+        row_numbers[device.qr_code] = number
+        values.append((device.name, device.serial_number, device.description, ean_device_id, location_id,
+                       device.quantity, device.condition, device.status, date.today(), device.qr_code, device.returned))
+        _add_stock(stock, dict(location_id=location_id, ean_device_id=ean_device_id, status=device.status,
+                               returned=device.returned, quantity=device.quantity), 1)
+
+    if values:
+        # COPY into a temporary table, then a single INSERT ... SELECT ... RETURNING in the same transaction,
+        # which also writes the creation event of every device. Only the COPY needs the DBAPI cursor; it is timed
+        # for the metrics here and is the one statement of the import the slow query log doesn't see
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(values)
+        buffer.seek(0)
+        columns = ', '.join(DEVICE_IMPORT_COLUMNS)
+        connection = db.connection()
+        connection.exec_driver_sql("CREATE TEMPORARY TABLE device_import ON COMMIT DROP AS SELECT {0} FROM devices WITH NO DATA".format(columns))
+        cursor = connection.connection.cursor()
+        start = time.perf_counter()
+        cursor.copy_expert("COPY device_import ({0}) FROM STDIN WITH (FORMAT csv)".format(columns), buffer)
+        metrics.record_statement(time.perf_counter() - start)
+        cursor.close()
+        prefix, suffix = DEVICE_CREATED_EVENT.split('{qr_code}')
+        created = connection.exec_driver_sql(
+            "WITH created AS (INSERT INTO devices ({0}) SELECT {0} FROM device_import RETURNING device_id, qr_code), "
+            "events AS (INSERT INTO device_histories (event, device_id, date) "
+            "SELECT %s || qr_code || %s, device_id, %s FROM created) "
+            "SELECT device_id, qr_code FROM created".format(columns), (prefix, suffix, datetime.now()))
+        for device_id, qr_code in created:
+            results.append(schemas.DeviceImportResultSchema(row=row_numbers[qr_code], device_id=device_id, qr_code=qr_code))
+        adjust_stock_levels(db, stock)
+        bump_table_versions(db, {models.Devices.__tablename__, models.Device_histories.__tablename__})
     db.commit()
-    db.refresh(n_device)
-    return n_device
-
-def update_device_by_id(db: Session, device_id: int, device: schemas.DevicesSchema):
-    n_device = db.query(models.Devices).filter(models.Devices.device_id == device_id).first()
-    n_device.name = device.name
-    n_device.serial_number = device.serial_number
-    n_device.description = device.description
-
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == device.ean_device.ean_device_id).first()
-    n_device.ean_device = ean_device
-    location = db.query(models.Locations).filter(models.Locations.location_id == device.location.location_id).first()
-    n_device.location = location
-
-    n_device.quantity = device.quantity
-    n_device.condition = device.condition
-    n_device.status = device.status
-    n_device.date_added = n_device.date_added
-    n_device.qr_code = device.qr_code
-    n_device.returned = device.returned
+    results.sort(key=lambda result: result.row)
+    return schemas.DeviceImportReportSchema(created=len(values), failed=len(results) - len(values), results=results)
+
+def _history_value(db: Session, column, value):
+    if column == 'location_id':
+        location = get_location_ref(db, location_id=value)
+        return location.name if location is not None else value
+    return value
+
+def device_history_events(db: Session, device, old, new):
+    # Event messages for every tracked column that differs between the old and new column values,
+    # plus one naming the other edited columns
+    events = [event.format(old=_history_value(db, column, old[column]), new=_history_value(db, column, new[column]),
+                           device=device)
+              for column, event in DEVICE_HISTORY_EVENTS.items() if old[column] != new[column]]
+    edited = [column for column in DEVICE_EDIT_COLUMNS if old[column] != new[column]]
+    if edited:
+        events.append(DEVICE_EDIT_EVENT.format(columns=', '.join(edited)))
+    return events
+
+def _update_device(db: Session, target, device: schemas.DevicesSchema, ean_device, location, version=None, device_id=None):
+    # A single UPDATE ... FROM the locked current row RETURNING both the old and the new values, which give the
+    # history events and stock deltas without a separate read. target selects the device; with a version only that
+    # version is updated, with a device_id the body may only name the same device. None when no row matched
+    old = select(models.Devices).where(target).order_by(models.Devices.device_id).limit(1).with_for_update() \
+        .subquery('old')
+    columns = tuple(DEVICE_HISTORY_EVENTS) + DEVICE_EDIT_COLUMNS
+    statement = update(models.Devices).where(models.Devices.device_id == old.c.device_id).values(
+        name=device.name, serial_number=device.serial_number, description=device.description,
+        ean_device_id=ean_device.ean_device_id, location_id=location.location_id, quantity=device.quantity,
+        condition=device.condition, status=device.status, qr_code=device.qr_code, returned=device.returned,
+        version=models.Devices.version + 1)
+    if version is not None:
+        statement = statement.where(models.Devices.version == version)
+    if device_id is not None:
+        other = aliased(models.Devices)
+        statement = statement.where(~exists().where(other.device_id == device_id, other.name != old.c.name))
+    statement = statement.returning(*(old.c[column].label('old_' + column) for column in columns),
+                                    *models.Devices.__table__.c).execution_options(synchronize_session=False)
+    row = db.execute(statement).first()
+    if row is None:
+        db.rollback()
+        return None
+    # location_id, quantity, returned, status and ean_device_id cover the stock_levels key as well
+    old = {column: row._mapping['old_' + column] for column in columns}
+    new = {column: row._mapping[column] for column in columns}
+    stock = {}
+    _add_stock(stock, old, -1)
+    _add_stock(stock, new, 1)
+    adjust_stock_levels(db, stock)
+    events = device_history_events(db, row, old, new)
+    tables = {models.Devices.__tablename__}
+    if events:
+        now = datetime.now()
+        db.execute(insert(models.Device_histories).values(
+            [dict(event=event, device_id=row.device_id, date=now) for event in events]))
+        tables.add(models.Device_histories.__tablename__)
+    bump_table_versions(db, tables)
     db.commit()
-    db.refresh(n_device)
-    return n_device
+    # The references were resolved by the caller, the response needs no further query
+    return schemas.DevicesSchema(**{column.name: row._mapping[column.name] for column in models.Devices.__table__.c},
+                                 ean_device=ean_device, location=location)
+
+def update_device_by_name(db: Session, name: str, device: schemas.DevicesSchema, version=None):
+    return _update_device(db, models.Devices.name == name, device,
+                          get_ean_device_ref(db, ean=device.ean_device.ean),
+                          get_location_ref(db, name=device.location.name), version, device.device_id)
+
+def update_device_by_id(db: Session, device_id: int, device: schemas.DevicesSchema, version=None):
+    return _update_device(db, models.Devices.device_id == device_id, device,
+                          get_ean_device_ref(db, ean_device_id=device.ean_device.ean_device_id),
+                          get_location_ref(db, location_id=device.location.location_id), version, device.device_id)
+
+
+def delete_devices(db: Session, device_ids):
+    # Set-based: one DELETE for the history rows and one for the devices, in one transaction.
+    # device_histories also cascades on delete, the explicit DELETE covers databases created before that
+    db.execute(delete(models.Device_histories).where(_any(models.Device_histories.device_id, device_ids))
+               .execution_options(synchronize_session=False))
+    deleted = db.execute(delete(models.Devices).where(_any(models.Devices.device_id, device_ids))
+                         .returning(models.Devices.device_id, *(getattr(models.Devices, column) for column in STOCK_KEY + ('quantity',)))
+                         .execution_options(synchronize_session=False)).all()
+    stock = {}
+    for row in deleted:
+        _add_stock(stock, row._mapping, -1)
+    adjust_stock_levels(db, stock)
+    if deleted:
+        # Syncing clients learn about the deletion from the tombstones, the history is gone
+        db.execute(insert(models.Device_tombstones).values([{'device_id': row.device_id} for row in deleted]))
+        bump_table_versions(db, {models.Devices.__tablename__, models.Device_histories.__tablename__})
+    db.commit()
+    return [row.device_id for row in deleted]
+
+
+def _delete_device(db: Session, db_device):
+    if db_device is None:
+        return None
+    # Serialized before the delete, the ORM object can't be refreshed once its row is gone
+    response = schemas.DevicesSchema.from_orm(db_device)
+    delete_devices(db, [db_device.device_id])
+    return response
 
 
 def delete_device_by_name(db: Session, name: str):
-    db_device = db.query(models.Devices).filter(models.Devices.name == name).first()
-    db.delete(db_device)
-    db.commit()
-    return db_device
+    db_device = db.query(models.Devices).filter(models.Devices.name == name).options(*DEVICE_LOAD).first()
+    return _delete_device(db, db_device)
 
 
 def delete_device_by_id(db: Session, device_id: int):
-    db_device = db.query(models.Devices).filter(models.Devices.device_id == device_id).first()
-    db.delete(db_device)
-    db.commit()
-    return db_device
+    db_device = db.query(models.Devices).filter(models.Devices.device_id == device_id).options(*DEVICE_LOAD).first()
+    return _delete_device(db, db_device)
+
+def resolve_scanned_codes(db: Session, qr_codes=(), serial_numbers=(), eans=()):
+    # Devices by QR code or serial number in one query and EAN devices in another, keyed by the scanned code.
+    # A code matching several kinds resolves to a QR code first, then a serial number, then an EAN
+    qr_codes, serial_numbers, eans = set(qr_codes) - {''}, set(serial_numbers) - {''}, set(eans) - {''}
+    results = {}
+    if qr_codes or serial_numbers:
+        query, build = _device_rows_query(db)
+        devices = [build(row) for row in query.filter(or_(_any(models.Devices.qr_code, qr_codes),
+                                                          _any(models.Devices.serial_number, serial_numbers)))]
+        for match, codes in (('qr_code', qr_codes), ('serial_number', serial_numbers)):
+            for device in devices:
+                if device[match] in codes:
+                    results.setdefault(device[match], {'match': match, 'device': device})
+    if eans:
+        query, build = _ean_device_rows_query(db)
+        for row in query.filter(_any(models.EAN_Devices.ean, eans)):
+            ean_device = build(row)
+            results.setdefault(ean_device['ean'], {'match': 'ean', 'ean_device': ean_device})
+    return results
+
+def _contains(text):
+    # ILIKE pattern matching text anywhere, with its own wildcards escaped
+    return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def search(db: Session, q: str, limit: int):
+    # Substring matches on the searched columns plus typo tolerant trigram matches on names and models, best first.
+    # Every condition is served by the pg_trgm GIN indexes, ranking only touches the matched rows
+    pattern = _contains(q)
+    query, build = _device_rows_query(db)
+    rank = func.greatest(func.similarity(models.Devices.name, q), func.similarity(models.Devices.serial_number, q),
+                         func.word_similarity(q, models.Devices.description))
+    devices = query.filter(or_(models.Devices.name.ilike(pattern), models.Devices.serial_number.ilike(pattern),
+                               models.Devices.description.ilike(pattern), models.Devices.name.op('%')(q))) \
+        .order_by(rank.desc(), models.Devices.device_id).limit(limit)
+    query, build_ean_device = _ean_device_rows_query(db)
+    ean_devices = query.filter(or_(models.EAN_Devices.model.ilike(pattern), models.EAN_Devices.model.op('%')(q))) \
+        .order_by(func.similarity(models.EAN_Devices.model, q).desc(), models.EAN_Devices.ean_device_id).limit(limit)
+    return {'devices': _rows(devices, build), 'ean_devices': _rows(ean_devices, build_ean_device)}
 
 # DeviceHistories
-def get_devices_histories(db: Session):
-    return db.query(models.Device_histories).all()
-
-def get_device_histories_by_name(db: Session, name: str):
-    return db.query(models.Device_histories).join(models.Devices).filter(models.Devices.name == name).all()
-
-def get_device_histories_by_id(db: Session, device_id: int):
-    return db.query(models.Device_histories).join(models.Devices).filter(models.Devices.device_id == device_id).all()
+def _histories_query(db: Session, expand):
+    # expand loads the full device graph of every event as ORM objects, otherwise only the event columns are read
+    if expand:
+        return db.query(models.Device_histories).options(*DEVICE_HISTORY_LOAD)
+    return db.query(*DEVICE_HISTORY_EVENT_COLUMNS)
+
+def _histories(query, expand, limit, after, stream, date_from=None, date_to=None):
+    # A date range lets PostgreSQL skip the monthly partitions outside it
+    if date_from is not None:
+        query = query.filter(models.Device_histories.date >= date_from)
+    if date_to is not None:
+        query = query.filter(models.Device_histories.date <= date_to)
+    histories = _keyset(query, models.Device_histories.history_id, limit, after, stream)
+    if expand:
+        return histories
+    # Compact events as dicts shaped like DeviceHistoryEventSchema
+    return _rows(histories, lambda row: row._asdict(), stream)
+
+def get_devices_histories(db: Session, limit=None, after=None, stream=False, expand=True, date_from=None, date_to=None):
+    query = _histories_query(db, expand)
+    return _histories(query, expand, limit, after, stream, date_from, date_to)
+
+def get_device_histories_by_name(db: Session, name: str, limit=None, after=None, stream=False, expand=True,
+                                 date_from=None, date_to=None):
+    query = _histories_query(db, expand).filter(models.Device_histories.device_id.in_(
+        select(models.Devices.device_id).where(models.Devices.name == name)))
+    return _histories(query, expand, limit, after, stream, date_from, date_to)
+
+def get_device_histories_by_id(db: Session, device_id: int, limit=None, after=None, stream=False, expand=True,
+                               date_from=None, date_to=None):
+    query = _histories_query(db, expand).filter(models.Device_histories.device_id == device_id)
+    return _histories(query, expand, limit, after, stream, date_from, date_to)
+
+# Position in the history of the change feed and of device sync, "<transaction_id>-<history_id>" of the last event
+# delivered.
+# history_ids are handed out before commit, not in commit order: a long transaction can commit ids below ones
+# already delivered. Events are therefore delivered in (transaction_id, history_id) order and only once their
+# transaction is older than every transaction still running, after which nothing can appear below them
+HISTORY_CURSOR_PATTERN = r'^\d+-\d+$'
+SAFE_TRANSACTION_HORIZON = literal_column('pg_snapshot_xmin(pg_current_snapshot())::text::bigint')
+
+
+def history_cursor(transaction_id, history_id):
+    return '{0}-{1}'.format(transaction_id, history_id)
+
+def parse_history_cursor(cursor):
+    transaction_id, _, history_id = cursor.partition('-')
+    if not (transaction_id.isdigit() and history_id.isdigit()):
+        raise InvalidCursor("Invalid history cursor {0!r}".format(cursor))
+    return int(transaction_id), int(history_id)
+
+def get_history_cursor(db: Session):
+    # The cursor of "now": every event of a finished transaction is behind it, those of running ones ahead
+    return history_cursor(db.query(SAFE_TRANSACTION_HORIZON).scalar(), 0)
+
+def get_history_cursor_before(db: Session, moment):
+    # The cursor of the last event written before a timestamp. Events of transactions that ran across the moment may
+    # fall on either side of it
+    histories = models.Device_histories
+    row = db.query(histories.transaction_id, histories.history_id).filter(histories.date < moment) \
+        .order_by(histories.date.desc(), histories.history_id.desc()).first()
+    return history_cursor(*row) if row else history_cursor(0, 0)
+
+def get_device_history_events(db: Session, after, device_ids=None, location_ids=None, limit=None,
+                              horizon=SAFE_TRANSACTION_HORIZON):
+    # (cursor, compact event) pairs after the cursor, of the given devices and of devices currently in the given
+    # locations. Only events of transactions below the horizon, by default read in the same statement
+    histories = models.Device_histories
+    transaction_id, history_id = parse_history_cursor(after)
+    query = db.query(histories.transaction_id, *DEVICE_HISTORY_EVENT_COLUMNS) \
+        .filter(tuple_(histories.transaction_id, histories.history_id) > tuple_(transaction_id, history_id),
+                histories.transaction_id < horizon)
+    if device_ids:
+        query = query.filter(_any(histories.device_id, device_ids))
+    if location_ids:
+        query = query.filter(histories.device_id.in_(
+            select(models.Devices.device_id).where(_any(models.Devices.location_id, location_ids))))
+    query = query.order_by(histories.transaction_id, histories.history_id).limit(limit)
+    return [(history_cursor(row.transaction_id, row.history_id),
+             {column.key: getattr(row, column.key) for column in DEVICE_HISTORY_EVENT_COLUMNS}) for row in query]
+
+def sync_devices(db: Session, since, limit, events=True):
+    # The next page of events after the since cursor, the current state of every device they touch and the devices
+    # deleted since. A page reaching the horizon ends at it, so the next sync starts from there. Deletions are
+    # matched by transaction and may be repeated by the next page, deleting twice is harmless
+    horizon = db.query(SAFE_TRANSACTION_HORIZON).scalar()
+    rows = get_device_history_events(db, since, limit=limit + 1, horizon=horizon)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    sync = compact_device_histories(db, [event for cursor, event in rows])
+    since = parse_history_cursor(since)
+    if has_more:
+        cursor = rows[-1][0]
+        until = parse_history_cursor(cursor)[0] + 1
+    else:
+        # Never behind since, a replica's horizon may lag the one a client last synced against
+        cursor = history_cursor(*max(since, (horizon, 0)))
+        until = horizon
+    tombstones = models.Device_tombstones
+    deleted = db.query(tombstones.device_id).filter(tombstones.transaction_id >= since[0], tombstones.transaction_id < until)
+    sync['deleted'] = [device_id for device_id, in deleted.order_by(tombstones.device_id)]
+    sync.update(cursor=cursor, has_more=has_more)
+    if not events:
+        sync['history'] = []
+    return sync
+
+def compact_device_histories(db: Session, histories):
+    # Each device referenced by the compact events is read and listed once
+    device_ids = {history['device_id'] for history in histories}
+    devices = []
+    if device_ids:
+        query, build = _device_rows_query(db)
+        devices = _rows(query.filter(_any(models.Devices.device_id, device_ids)).order_by(models.Devices.device_id), build)
+    return {'history': histories, 'devices': devices}
 
 def create_device_history(db: Session, event, device):
     db_device_history = models.Device_histories(event=event, device=device, date=datetime.now())
@@ -370,12 +1036,42 @@ def create_device_history(db: Session, event, device):
     db.refresh(db_device_history)
     return db_device_history
 
-def delete_device_history_by_name(db: Session, name: str):
-    db_device_history = db.query(models.Device_histories).join(models.Devices).filter(models.Devices.name == name).all()
-    for d in db_device_history:
-        db.delete(d)
-        db.commit()
-    return db_device_history
+# Idempotency keys
+def reserve_idempotency_key(db: Session, key: str, fingerprint: str, ttl, in_progress_timeout):
+    # Claims the key for the request about to run and returns None, or returns the stored (fingerprint, status_code,
+    # content_type, body) of an earlier request with the key; status_code is None while that one still runs.
+    # Expired keys and reservations left behind by a crashed worker are claimed again
+    keys = models.Idempotency_keys
+    db.execute(delete(keys).where(keys.key == key, or_(
+        keys.created_at < func.now() - timedelta(seconds=ttl),
+        and_(keys.status_code.is_(None), keys.created_at < func.now() - timedelta(seconds=in_progress_timeout))))
+               .execution_options(synchronize_session=False))
+    claimed = db.execute(pg_insert(keys).values(key=key, fingerprint=fingerprint).on_conflict_do_nothing()
+                         .returning(keys.key)).first()
+    stored = None
+    if claimed is None:
+        stored = db.query(keys.fingerprint, keys.status_code, keys.content_type, keys.body).filter(keys.key == key).first()
+    db.commit()
+    return stored
+
+def store_idempotent_response(db: Session, key: str, status_code, content_type, body):
+    keys = models.Idempotency_keys
+    db.execute(update(keys).where(keys.key == key).values(status_code=status_code, content_type=content_type, body=body)
+               .execution_options(synchronize_session=False))
+    db.commit()
+
+def release_idempotency_key(db: Session, key: str):
+    # The request failed without a response worth replaying, a retry executes it again
+    keys = models.Idempotency_keys
+    db.execute(delete(keys).where(keys.key == key, keys.status_code.is_(None)).execution_options(synchronize_session=False))
+    db.commit()
+
+def purge_idempotency_keys(db: Session, ttl):
+    keys = models.Idempotency_keys
+    deleted = db.execute(delete(keys).where(keys.created_at < func.now() - timedelta(seconds=ttl))
+                         .execution_options(synchronize_session=False)).rowcount
+    db.commit()
+    return deleted
 
 # # UserAuthentication
 # def get_users(db: Session):
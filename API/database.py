@@ -1,13 +1,125 @@
-from sqlalchemy import create_engine
+import os
+import threading
+import time
+from sqlalchemy import create_engine, event, exc
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.pool import QueuePool
 from configparser import ConfigParser
+from API.metrics import instrument_engine
+from API.slow_queries import SlowQueryLog
 
 config = ConfigParser()
 config.read('../database.ini')
-DB_URL = 'postgresql+psycopg2://{user}:{pw}@{url}/{db}'.format(user=config.get('postgresql', 'user'), pw=config.get('postgresql','password'), url=config.get('postgresql', 'host')+":"+config.get('postgresql', 'port'), db=config.get('postgresql', 'database'))
 
-engine = create_engine(DB_URL)
+
+def get_setting(section, option, fallback=None, cast=str):
+    # INVENTORY_<SECTION>_<OPTION> in the environment overrides database.ini
+    value = os.environ.get('INVENTORY_{0}_{1}'.format(section, option).upper())
+    if value is None:
+        value = config.get(section, option, fallback=None)
+    if value is None:
+        return fallback
+    return cast(value)
+
+
+def as_bool(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def database_url(section):
+    return 'postgresql+psycopg2://{user}:{pw}@{url}/{db}'.format(user=get_setting(section, 'user'), pw=get_setting(section, 'password'), url=get_setting(section, 'host')+":"+get_setting(section, 'port'), db=get_setting(section, 'database'))
+
+
+DB_URL = database_url('postgresql')
+# Optional streaming replica for read-only routes, the [postgresql_replica] section of database.ini
+REPLICA_URL = database_url('postgresql_replica') if get_setting('postgresql_replica', 'host') else None
+
+# Routes are plain "def" functions executed in a bounded worker thread pool, one DB connection per worker thread
+THREAD_POOL_SIZE = get_setting('api', 'thread_pool_size', 40, int)
+
+# Engine and pool tuning, the [engine] section of database.ini
+POOL_SIZE = get_setting('engine', 'pool_size', THREAD_POOL_SIZE, int)
+MAX_OVERFLOW = get_setting('engine', 'max_overflow', 10, int)
+POOL_TIMEOUT = get_setting('engine', 'pool_timeout', 30.0, float)
+POOL_RECYCLE = get_setting('engine', 'pool_recycle', 1800, int)
+POOL_PRE_PING = get_setting('engine', 'pool_pre_ping', True, as_bool)
+CONNECT_TIMEOUT = get_setting('engine', 'connect_timeout', 10, int)
+STATEMENT_TIMEOUT = get_setting('engine', 'statement_timeout', 0, int)
+APPLICATION_NAME = get_setting('engine', 'application_name', 'inventory-api')
+# PgBouncer in transaction pooling mode drops startup "options" and session state between transactions.
+# psycopg2 never uses server-side prepared statements, so those need no special handling
+PGBOUNCER = get_setting('engine', 'pgbouncer', False, as_bool)
+# After a write, the same client reads from the primary for this many seconds so it sees its own changes
+REPLICA_STICKINESS = get_setting('engine', 'replica_stickiness', 5.0, float)
+# Statements slower than threshold ms are logged and explained, the [slow_query] section of database.ini; 0 disables
+SLOW_QUERY_THRESHOLD = get_setting('slow_query', 'threshold', 500, float)
+SLOW_QUERY_EXPLAIN = get_setting('slow_query', 'explain', True, as_bool)
+SLOW_QUERY_EXPLAIN_TIMEOUT = get_setting('slow_query', 'explain_timeout', 10000, int)
+SLOW_QUERY_EXPLAIN_INTERVAL = get_setting('slow_query', 'explain_interval', 300.0, float)
+
+
+class MeteredQueuePool(QueuePool):
+    # QueuePool that records how often and how long checkouts wait for a connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._metrics_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._metrics_lock:
+                self.checkouts += 1
+                self.timeouts += timed_out
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+
+
+def connect_args():
+    args = {'application_name': APPLICATION_NAME, 'connect_timeout': CONNECT_TIMEOUT}
+    if STATEMENT_TIMEOUT and not PGBOUNCER:
+        args['options'] = '-c statement_timeout={0}'.format(STATEMENT_TIMEOUT)
+    return args
+
+
+def make_engine(url):
+    db_engine = create_engine(url, poolclass=MeteredQueuePool, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW,
+                              pool_timeout=POOL_TIMEOUT, pool_recycle=POOL_RECYCLE, pool_pre_ping=POOL_PRE_PING,
+                              connect_args=connect_args())
+    instrument_engine(db_engine)
+    if SLOW_QUERY_THRESHOLD > 0:
+        SlowQueryLog(db_engine, SLOW_QUERY_THRESHOLD, SLOW_QUERY_EXPLAIN, SLOW_QUERY_EXPLAIN_TIMEOUT,
+                     SLOW_QUERY_EXPLAIN_INTERVAL)
+    if STATEMENT_TIMEOUT and PGBOUNCER:
+        @event.listens_for(db_engine, 'begin')
+        def set_statement_timeout(conn):
+            # Transaction scoped, so it never leaks to another client sharing the server connection
+            conn.exec_driver_sql('SET LOCAL statement_timeout = {0}'.format(STATEMENT_TIMEOUT))
+    return db_engine
+
+
+def pool_status(db_engine):
+    pool = db_engine.pool
+    return {'size': pool.size(), 'checked_in': pool.checkedin(), 'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0), 'checkouts': pool.checkouts, 'timeouts': pool.timeouts,
+            'wait_seconds_total': pool.wait_time, 'max_wait_seconds': pool.max_wait_time}
+
+
+engine = make_engine(DB_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
\ No newline at end of file
+replica_engine = make_engine(REPLICA_URL) if REPLICA_URL else None
+ReplicaSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=replica_engine) if replica_engine else SessionLocal
+
+Base = declarative_base()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import select
+import threading
+import time
+from API.database import engine, connect_args
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_DELAY = 5.0
+
+
+class Subscription:
+    # Set by the listener thread whenever a watched channel is notified, waited on by one streaming response
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.event = asyncio.Event()
+
+    def notify(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout):
+        # True when notified, False when the timeout passed first
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.event.clear()
+        return True
+
+
+class ChangeFeed:
+    # One LISTEN connection per process, shared by every subscriber. Notifications carry no rows: subscribers
+    # read what changed after their own cursor, so coalesced or missed notifications lose nothing
+    def __init__(self, channel):
+        self.channel = channel
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self):
+        subscription = Subscription()
+        with self._lock:
+            self._subscriptions.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="feed-" + self.channel, daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _wake(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.notify()
+
+    def _connect(self):
+        # A dedicated connection outside the pool, it stays checked out for the life of the process
+        args, params = engine.dialect.create_connect_args(engine.url)
+        params.update(connect_args())
+        connection = engine.dialect.connect(*args, **params)
+        connection.autocommit = True
+        return connection
+
+    def _listen(self):
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                connection.cursor().execute("LISTEN {0}".format(self.channel))
+                # Anything written while the connection was down is picked up by the subscribers' next read
+                self._wake()
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    if connection.notifies:
+                        connection.notifies.clear()
+                        self._wake()
+            except Exception:
+                logger.exception("Change feed listener for %s failed, reconnecting", self.channel)
+                time.sleep(RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    connection.close()
@@ -0,0 +1,128 @@
+import hashlib
+import time
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, Response
+from API.database import SessionLocal, get_setting
+import API.crud as crud
+
+# Writes sent with an Idempotency-Key header run once: a retry with the same key and request gets the stored
+# response back instead of executing again. The [idempotency] section of database.ini sets how long keys are kept
+# and after how many seconds a reservation whose request never finished is considered abandoned
+HEADER = "idempotency-key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+TTL = get_setting('idempotency', 'ttl', 86400, int)
+IN_PROGRESS_TIMEOUT = get_setting('idempotency', 'in_progress_timeout', 300, int)
+PURGE_INTERVAL = 3600.0
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_last_purge = 0.0
+
+
+def fingerprint(scope, body):
+    digest = hashlib.sha256()
+    for part in (scope["method"].encode(), scope["path"].encode(), scope.get("query_string", b""), body):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def _reserve(key, request_fingerprint):
+    global _last_purge
+    with SessionLocal() as db:
+        if time.monotonic() - _last_purge > PURGE_INTERVAL:
+            _last_purge = time.monotonic()
+            crud.purge_idempotency_keys(db, TTL)
+        return crud.reserve_idempotency_key(db, key, request_fingerprint, TTL, IN_PROGRESS_TIMEOUT)
+
+
+def _store(key, status_code, content_type, body):
+    with SessionLocal() as db:
+        crud.store_idempotent_response(db, key, status_code, content_type, body)
+
+
+def _release(key):
+    with SessionLocal() as db:
+        crud.release_idempotency_key(db, key)
+
+
+class IdempotencyMiddleware:
+    # Pure ASGI, the request body has to be read here and handed on to the route unchanged
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] in SAFE_METHODS:
+            await self.app(scope, receive, send)
+            return
+        key = dict(scope["headers"]).get(HEADER.encode())
+        if key is None:
+            await self.app(scope, receive, send)
+            return
+        key = key.decode("latin-1")
+        if not key or len(key) > MAX_KEY_LENGTH:
+            await JSONResponse({"detail": f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters"}, 400)(scope, receive, send)
+            return
+
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if message["type"] != "http.request" or not message.get("more_body", False):
+                break
+        body = b"".join(chunks)
+        request_fingerprint = fingerprint(scope, body)
+
+        stored = await run_in_threadpool(_reserve, key, request_fingerprint)
+        if stored is not None:
+            if stored.fingerprint != request_fingerprint:
+                response = JSONResponse({"detail": "Idempotency-Key was already used for a different request"}, 422)
+            elif stored.status_code is None:
+                response = JSONResponse({"detail": "A request with this Idempotency-Key is still being processed"}, 409)
+            else:
+                headers = {REPLAYED_HEADER: "true"}
+                if stored.content_type:
+                    headers["content-type"] = stored.content_type
+                response = Response(stored.body, stored.status_code, headers)
+            await response(scope, receive, send)
+            return
+
+        body_sent = False
+
+        async def replay_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response_start, response_body = {}, []
+        finished = False
+
+        async def capture(message):
+            # The response is stored before its last chunk goes out, a retry never finds it still in progress
+            nonlocal finished
+            if message["type"] == "http.response.start":
+                response_start.update(message)
+            elif message["type"] == "http.response.body":
+                response_body.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    finished = True
+                    await self.finish(key, response_start, b"".join(response_body))
+            await send(message)
+
+        try:
+            await self.app(scope, replay_body, capture)
+        except Exception:
+            if not finished:
+                await run_in_threadpool(_release, key)
+            raise
+
+    async def finish(self, key, response_start, body):
+        status_code = response_start["status"]
+        if status_code >= 500:
+            # Server errors are not replayed, the client's retry runs the request again
+            await run_in_threadpool(_release, key)
+            return
+        content_type = dict(response_start.get("headers", [])).get(b"content-type")
+        await run_in_threadpool(_store, key, status_code, content_type.decode("latin-1") if content_type else None, body)
@@ -1,11 +1,43 @@
+import csv
+import io
+import json
+import re
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, status
-from API.database import SessionLocal, engine
+from anyio import to_thread
+import psycopg2
+from psycopg2 import errorcodes
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import DataError, IntegrityError
+import time
+from datetime import date, datetime
+from API.serialization import FastJSONResponse, dumps
+from API.database import SessionLocal, ReplicaSessionLocal, engine, replica_engine, pool_status, get_setting, REPLICA_STICKINESS, THREAD_POOL_SIZE
 import API.models as models
 import API.schemas as schemas
 import API.crud as crud
+import API.partitions as partitions
+from API.feed import ChangeFeed
+from API.idempotency import IdempotencyMiddleware
+import API.metrics as metrics
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from starlette.middleware.base import BaseHTTPMiddleware
+from typing import List, Optional, Union
+
+LAST_WRITE_COOKIE = "inventory_last_write"
+READ_YOUR_WRITES_HEADER = "X-Read-Your-Writes"
+# POST routes that only read, they don't pin the client to the primary
+READ_ONLY_POSTS = {"/scan/resolve"}
+# Clients may reuse reference table responses (locations, producers, categories, EAN devices) for this many seconds
+# without revalidating, everything else is revalidated with its ETag on every request
+REFERENCE_MAX_AGE = get_setting('http', 'reference_max_age', 60, int)
+# Seconds between keep-alive comments on an idle change feed, and events read per query
+FEED_HEARTBEAT = get_setting('feed', 'heartbeat', 15.0, float)
+FEED_BATCH_SIZE = 500
+SYNC_PAGE_SIZE = 1000
+
 
 # Dependency
 def get_db():
@@ -15,26 +47,254 @@ def get_db():
     finally:
         db.close()
 
+
+def reads_own_writes(request: Request):
+    # The header forces a primary read, the cookie keeps a client on the primary for a while after its last write
+    if request.headers.get(READ_YOUR_WRITES_HEADER, "").lower() in ("1", "true", "yes"):
+        return True
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        return False
+    return time.time() - last_write < REPLICA_STICKINESS
+
+
+def get_read_db(request: Request):
+    # Read-only routes go to the replica when one is configured
+    db = SessionLocal() if reads_own_writes(request) else ReplicaSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def ndjson_response(db: Session, get_rows, schema=None, **params):
+    # Streams one JSON document per line from a server-side cursor on the request's session: FastAPI closes
+    # the session of a yield dependency only once the response is sent, the stream reads in the transaction
+    # the ETag was read in. Without a schema the rows are dicts already built by crud and are only encoded
+    # Called before the response starts, so invalid parameters are still answered with an error status
+    stream_rows = get_rows(db, stream=True, **params)
+
+    def rows():
+        for row in stream_rows:
+            # One encoder for every stream, ORM rows are converted through their schema first
+            yield dumps(row if schema is None else schema.from_orm(row).dict()) + b"\n"
+    return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+
+class NotModified(Exception):
+    def __init__(self, etag, cache_control):
+        self.etag = etag
+        self.cache_control = cache_control
+
+
+def etag_matches(if_none_match, etag):
+    # Weak comparison, as If-None-Match requires
+    if if_none_match is None:
+        return False
+    opaque = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or opaque(etag) in map(opaque, tags)
+
+
+class TableVersionETag:
+    # Dependency of the GET routes: the ETag is built from the change counters of the tables behind the response,
+    # read before anything else. A matching If-None-Match ends the request with 304 before the route runs its query
+    def __init__(self, *tables, max_age=None):
+        self.tables = tables
+        self.cache_control = "max-age={0}".format(max_age) if max_age else "no-cache"
+
+    def __call__(self, request: Request, db: Session = Depends(get_read_db)):
+        etag = 'W/"{0}"'.format(".".join(map(str, crud.get_table_versions(db, self.tables))))
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            raise NotModified(etag, self.cache_control)
+        request.state.etag = etag
+        request.state.cache_control = self.cache_control
+
+
+LOCATIONS_ETAG = TableVersionETag("locations", max_age=REFERENCE_MAX_AGE)
+PRODUCERS_ETAG = TableVersionETag("producers", max_age=REFERENCE_MAX_AGE)
+CATEGORIES_ETAG = TableVersionETag("categories", max_age=REFERENCE_MAX_AGE)
+EAN_DEVICES_ETAG = TableVersionETag("ean_devices", "categories", "producers", max_age=REFERENCE_MAX_AGE)
+DEVICES_ETAG = TableVersionETag("devices", "locations", "ean_devices", "categories", "producers")
+DEVICE_HISTORIES_ETAG = TableVersionETag("device_histories", "devices", "locations", "ean_devices", "categories", "producers")
+
+
+def parse_device_import(content_type, body):
+    # Accepts a JSON array, NDJSON or CSV with a header row, as sent in the Content-Type
+    text = body.decode('utf-8-sig')
+    if content_type == 'text/csv':
+        # Empty CSV cells fall back to the schema defaults
+        rows = [{k: v for k, v in row.items() if v != ''} for row in csv.DictReader(io.StringIO(text))]
+    elif content_type in ('application/x-ndjson', 'application/jsonl'):
+        rows = [json.loads(line) for line in text.splitlines() if line.strip()]
+    else:
+        rows = json.loads(text)
+        if not isinstance(rows, list):
+            raise ValueError("Expected a JSON array of devices")
+    # PostgreSQL text can't hold NUL characters, psycopg2 would refuse them only when the rows are inserted
+    if any(isinstance(value, str) and '\0' in value for row in rows if isinstance(row, dict) for value in row.values()):
+        raise ValueError("NUL characters are not allowed")
+    return rows
+
+
+def parse_fields(fields, allowed):
+    # ?fields=name,status selects only those top level fields, in that order
+    if fields is None:
+        return None
+    selected = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in selected if field not in allowed]
+    if not selected or unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}. Allowed: {', '.join(allowed)}")
+    return selected
+
+
+def sort_pattern(sort_keys):
+    # A sort key, descending with a "-" prefix
+    return "^-?({0})$".format("|".join(sort_keys))
+
+
+def set_device_etag(request, device):
+    # A single device carries its version as a strong ETag, for PUTs to send back in If-Match. It doesn't serve
+    # If-None-Match: the version stays the same when the location or EAN device embedded in the response is renamed
+    request.state.etag = '"{0}"'.format(device.version)
+    request.state.cache_control = "no-cache"
+
+
+def expected_version(if_match, device):
+    # The device version a PUT applies to: If-Match with the device's ETag, "<version>", else the version in
+    # the body. Without either the update is unconditional. Any other tag, weak ones included, can't match
+    if if_match is None or if_match.strip() == "*":
+        return device.version
+    match = re.fullmatch(r'"(\d+)"', if_match.strip())
+    if match is None:
+        raise HTTPException(status_code=412, detail='If-Match must hold the ETag of the device, e.g. "3"')
+    return int(match.group(1))
+
+
+def device_update_error(current, version):
+    # Why a device UPDATE matched no row, from the device as it is now
+    if current is None:
+        return HTTPException(status_code=404, detail="Device not found")
+    if version is not None and current.version != version:
+        return HTTPException(status_code=412, detail=f"Device was modified, its current version is {current.version}")
+    return HTTPException(status_code=409, detail="Device already exists")
+
+
+def device_histories_response(db: Session, get_histories, expand, stream, **params):
+    # Compact by default: events carry a device_id and every device is listed once next to them.
+    # ?expand=device nests the full device in each event instead
+    expand = expand == "device"
+    if stream:
+        schema = schemas.DeviceHistoriesSchema if expand else None
+        return ndjson_response(db, get_histories, schema, expand=expand, **params)
+    histories = get_histories(db, expand=expand, **params)
+    if expand:
+        return histories
+    return FastJSONResponse(crud.compact_device_histories(db, histories))
+
 models.Base.metadata.create_all(bind=engine)
+with engine.begin() as setup_connection:
+    if not partitions.is_partitioned(setup_connection):
+        raise SystemExit("device_histories was created before it was partitioned by month. Convert it with "
+                         "'python db_creator.py partition' in DB/ before starting the API")
+    # Databases created before devices.version; a constant default doesn't rewrite the table
+    if 'version' not in {column['name'] for column in inspect(setup_connection).get_columns('devices')}:
+        setup_connection.execute(text("ALTER TABLE devices ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+    # and before device_histories.transaction_id: existing events count as written by a long finished transaction
+    if 'transaction_id' not in {column['name'] for column in inspect(setup_connection).get_columns('device_histories')}:
+        setup_connection.execute(text("ALTER TABLE device_histories ADD COLUMN transaction_id BIGINT NOT NULL DEFAULT 0"))
+        setup_connection.execute(text("ALTER TABLE device_histories ALTER COLUMN transaction_id "
+                                      "SET DEFAULT pg_current_xact_id()::text::bigint"))
+partitions.ensure_partitions(engine)
+with SessionLocal() as setup_db:
+    if crud.stock_levels_missing(setup_db):
+        crud.rebuild_stock_levels(setup_db)
+history_feed = ChangeFeed(crud.HISTORY_CHANNEL)
 app = FastAPI(title="Inventory API")
+# Innermost of the middleware, so replayed responses pass through the others like executed ones
+app.add_middleware(IdempotencyMiddleware)
+
+
+class ReadYourWritesMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        if request.method not in ("GET", "HEAD", "OPTIONS") and request.url.path not in READ_ONLY_POSTS \
+                and response.status_code < 400:
+            response.set_cookie(LAST_WRITE_COOKIE, str(time.time()), max_age=max(int(REPLICA_STICKINESS), 1), httponly=True)
+        return response
+
+
+if replica_engine is not None:
+    app.add_middleware(ReadYourWritesMiddleware)
+
+
+class ConditionalGetMiddleware(BaseHTTPMiddleware):
+    # Adds the ETag and Cache-Control set by a TableVersionETag dependency or set_device_etag to successful responses
+    async def dispatch(self, request, call_next):
+        response = await call_next(request)
+        etag = getattr(request.state, "etag", None)
+        if etag is not None and response.status_code == 200:
+            response.headers["ETag"] = etag
+            response.headers["Cache-Control"] = request.state.cache_control
+        return response
+
+
+app.add_middleware(ConditionalGetMiddleware)
+# Added last so it wraps the other middleware and times the whole request
+app.add_middleware(metrics.MetricsMiddleware)
+
+
+@app.exception_handler(IntegrityError)
+async def integrity_error_handler(request, error):
+    # Constraint violations the routes don't report themselves, e.g. a reference deleted by a concurrent request
+    if getattr(error.orig, "pgcode", None) == errorcodes.UNIQUE_VIOLATION:
+        return JSONResponse({"detail": "Conflicts with an existing record"}, status_code=409)
+    return JSONResponse({"detail": "Violates a database constraint"}, status_code=400)
+
+
+@app.exception_handler(crud.InvalidCursor)
+async def invalid_cursor_handler(request, error):
+    return JSONResponse({"detail": str(error)}, status_code=400)
+
+
+@app.exception_handler(NotModified)
+async def not_modified_handler(request, error):
+    return Response(status_code=304, headers={"ETag": error.etag, "Cache-Control": error.cache_control})
+
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    # Sync routes run in anyio's default thread pool, size it to match the DB connection pool
+    to_thread.current_default_thread_limiter().total_tokens = THREAD_POOL_SIZE
+
+
+@app.on_event("startup")
+def start_partition_maintenance():
+    # New monthly device history partitions ahead of time, old ones archived per the retention policy
+    partitions.maintain_partitions(engine)
+    partitions.start_maintenance(engine)
+
 
 # Locations
-@app.get("/locations/", response_model=List[schemas.LocationsSchema], tags=["Locations"])
-async def get_locations(db: Session = Depends(get_db)):
-    locations = crud.get_locations(db)
+@app.get("/locations/", response_model=List[schemas.LocationsSchema], tags=["Locations"], dependencies=[Depends(LOCATIONS_ETAG)])
+def get_locations(db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False):
+    if stream:
+        return ndjson_response(db, crud.get_locations, schemas.LocationsSchema, limit=limit, after=after)
+    locations = crud.get_locations(db, limit=limit, after=after)
     return locations
 
 
-@app.get("/locations/name/{location_name}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def get_location_by_name(location_name: str, db: Session = Depends(get_db)):
+@app.get("/locations/name/{location_name}", response_model=schemas.LocationsSchema, tags=["Locations"], dependencies=[Depends(LOCATIONS_ETAG)])
+def get_location_by_name(location_name: str, db: Session = Depends(get_read_db)):
     db_location = crud.get_location_by_name(db, name=location_name)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
     return db_location
 
 
-@app.get("/locations/id/{location_id}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def get_location_by_id(location_id: int, db: Session = Depends(get_db)):
+@app.get("/locations/id/{location_id}", response_model=schemas.LocationsSchema, tags=["Locations"], dependencies=[Depends(LOCATIONS_ETAG)])
+def get_location_by_id(location_id: int, db: Session = Depends(get_read_db)):
     db_location = crud.get_location_by_id(db, location_id=location_id)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
@@ -42,38 +302,38 @@ async def get_location_by_id(location_id: int, db: Session = Depends(get_db)):
 
 
 @app.post("/locations/", response_model=schemas.LocationsSchema, tags=["Locations"], status_code=201)
-async def create_location(location: schemas.LocationsSchema, db: Session = Depends(get_db)):
-    db_location = crud.get_location_by_name(db, name=location.name)
-    if db_location:
-        raise HTTPException(status_code=400, detail="Location already exists")
-    return crud.create_location(db=db, location=location)
+def create_location(location: schemas.LocationsSchema, db: Session = Depends(get_db)):
+    db_location = crud.create_location(db=db, location=location)
+    if db_location is None:
+        raise HTTPException(status_code=409, detail="Location already exists")
+    return db_location
 
 
 @app.put("/locations/name/{location_name}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def update_location_by_name(location_name: str, location: schemas.LocationsSchema, db: Session = Depends(get_db)):
-    db_location = crud.get_location_by_name(db, name=location_name)
+def update_location_by_name(location_name: str, location: schemas.LocationsSchema, db: Session = Depends(get_db)):
+    db_location = crud.get_location_ref(db, name=location_name)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
-    n_location = db.query(models.Locations).filter(models.Locations.name == location.name).first()
+    n_location = crud.get_location_ref(db, name=location.name)
     if n_location is not None and db_location.name != n_location.name:
-        raise HTTPException(status_code=400, detail="Location already exists")
+        raise HTTPException(status_code=409, detail="Location already exists")
     return crud.update_location_by_name(db=db, name=location_name, location=location)
 
 
 @app.put("/locations/id/{location_id}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def update_location_by_id(location_id: int, location: schemas.LocationsSchema, db: Session = Depends(get_db)):
-    db_location = crud.get_location_by_id(db, location_id=location_id)
+def update_location_by_id(location_id: int, location: schemas.LocationsSchema, db: Session = Depends(get_db)):
+    db_location = crud.get_location_ref(db, location_id=location_id)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
-    n_location = db.query(models.Locations).filter(models.Locations.name == location.name).first()
+    n_location = crud.get_location_ref(db, name=location.name)
     if n_location is not None and db_location.name != n_location.name:
-        raise HTTPException(status_code=400, detail="Location already exists")
+        raise HTTPException(status_code=409, detail="Location already exists")
     return crud.update_location_by_id(db=db, location_id=location_id, location=location)
 
 
 @app.delete("/locations/name/{location_name}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def delete_location_by_name(location_name: str, db: Session = Depends(get_db)):
-    db_location = crud.get_location_by_name(db, name=location_name)
+def delete_location_by_name(location_name: str, db: Session = Depends(get_db)):
+    db_location = crud.get_location_ref(db, name=location_name)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
     db_location_devices = db.query(models.Devices).join(models.Locations).filter(models.Locations.name == location_name).all()
@@ -83,8 +343,8 @@ async def delete_location_by_name(location_name: str, db: Session = Depends(get_
 
 
 @app.delete("/locations/id/{location_id}", response_model=schemas.LocationsSchema, tags=["Locations"])
-async def delete_location_by_id(location_id: int, db: Session = Depends(get_db)):
-    db_location = crud.get_location_by_id(db, location_id=location_id)
+def delete_location_by_id(location_id: int, db: Session = Depends(get_db)):
+    db_location = crud.get_location_ref(db, location_id=location_id)
     if db_location is None:
         raise HTTPException(status_code=404, detail="Location not found")
     db_location_devices = db.query(models.Devices).join(models.Locations).filter(models.Locations.location_id == location_id).all()
@@ -93,22 +353,24 @@ async def delete_location_by_id(location_id: int, db: Session = Depends(get_db))
     return crud.delete_location_by_id(db=db, location_id=location_id)
 
 # Producers
-@app.get("/producers/", response_model=List[schemas.ProducersSchema], tags=["Producers"])
-async def get_producers(db: Session = Depends(get_db)):
-    producers = crud.get_producers(db)
+@app.get("/producers/", response_model=List[schemas.ProducersSchema], tags=["Producers"], dependencies=[Depends(PRODUCERS_ETAG)])
+def get_producers(db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False):
+    if stream:
+        return ndjson_response(db, crud.get_producers, schemas.ProducersSchema, limit=limit, after=after)
+    producers = crud.get_producers(db, limit=limit, after=after)
     return producers
 
 
-@app.get("/producers/name/{producer_name}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def get_producer_by_name(producer_name: str, db: Session = Depends(get_db)):
+@app.get("/producers/name/{producer_name}", response_model=schemas.ProducersSchema, tags=["Producers"], dependencies=[Depends(PRODUCERS_ETAG)])
+def get_producer_by_name(producer_name: str, db: Session = Depends(get_read_db)):
     db_producer = crud.get_producer_by_name(db, name=producer_name)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
     return db_producer
 
 
-@app.get("/producers/id/{producer_id}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def get_producer_by_id(producer_id: int, db: Session = Depends(get_db)):
+@app.get("/producers/id/{producer_id}", response_model=schemas.ProducersSchema, tags=["Producers"], dependencies=[Depends(PRODUCERS_ETAG)])
+def get_producer_by_id(producer_id: int, db: Session = Depends(get_read_db)):
     db_producer = crud.get_producer_by_id(db, producer_id=producer_id)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
@@ -116,38 +378,38 @@ async def get_producer_by_id(producer_id: int, db: Session = Depends(get_db)):
 
 
 @app.post("/producers/", response_model=schemas.ProducersSchema, tags=["Producers"], status_code=201)
-async def create_producer(producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
-    db_producer = crud.get_producer_by_name(db, name=producer.name)
-    if db_producer:
-        raise HTTPException(status_code=400, detail="Producer already exists")
-    return crud.create_producer(db=db, producer=producer)
+def create_producer(producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
+    db_producer = crud.create_producer(db=db, producer=producer)
+    if db_producer is None:
+        raise HTTPException(status_code=409, detail="Producer already exists")
+    return db_producer
 
 
 @app.put("/producers/name/{producer_name}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def update_producer_by_name(producer_name: str, producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
-    db_producer = crud.get_producer_by_name(db, name=producer_name)
+def update_producer_by_name(producer_name: str, producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
+    db_producer = crud.get_producer_ref(db, name=producer_name)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
-    n_producer = db.query(models.Producers).filter(models.Producers.name == producer.name).first()
+    n_producer = crud.get_producer_ref(db, name=producer.name)
     if n_producer is not None and db_producer.name != n_producer.name:
-        raise HTTPException(status_code=400, detail="Producer already exists")
+        raise HTTPException(status_code=409, detail="Producer already exists")
     return crud.update_producer_by_name(db=db, name=producer_name, producer=producer)
 
 
 @app.put("/producers/id/{producer_id}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def update_producer_by_id(producer_id: int, producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
-    db_producer = crud.get_producer_by_id(db, producer_id=producer_id)
+def update_producer_by_id(producer_id: int, producer: schemas.ProducersSchema, db: Session = Depends(get_db)):
+    db_producer = crud.get_producer_ref(db, producer_id=producer_id)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
-    n_producer = db.query(models.Producers).filter(models.Producers.name == producer.name).first()
+    n_producer = crud.get_producer_ref(db, name=producer.name)
     if n_producer is not None and db_producer.name != n_producer.name:
-        raise HTTPException(status_code=400, detail="Producer already exists")
+        raise HTTPException(status_code=409, detail="Producer already exists")
     return crud.update_producer_by_id(db=db, producer_id=producer_id, producer=producer)
 
 
 @app.delete("/producers/name/{producer_name}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def delete_producer_by_name(producer_name: str, db: Session = Depends(get_db)):
-    db_producer = crud.get_producer_by_name(db, name=producer_name)
+def delete_producer_by_name(producer_name: str, db: Session = Depends(get_db)):
+    db_producer = crud.get_producer_ref(db, name=producer_name)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
     db_producer_ean_devices = db.query(models.EAN_Devices).join(models.Producers).filter(models.Producers.name == producer_name).all()
@@ -157,8 +419,8 @@ async def delete_producer_by_name(producer_name: str, db: Session = Depends(get_
 
 
 @app.delete("/producers/id/{producer_id}", response_model=schemas.ProducersSchema, tags=["Producers"])
-async def delete_producer_by_id(producer_id: int, db: Session = Depends(get_db)):
-    db_producer = crud.get_producer_by_id(db, producer_id=producer_id)
+def delete_producer_by_id(producer_id: int, db: Session = Depends(get_db)):
+    db_producer = crud.get_producer_ref(db, producer_id=producer_id)
     if db_producer is None:
         raise HTTPException(status_code=404, detail="Producer not found")
     db_producer_ean_devices = db.query(models.EAN_Devices).join(models.Producers).filter(models.Producers.producer_id == producer_id).all()
@@ -167,22 +429,24 @@ async def delete_producer_by_id(producer_id: int, db: Session = Depends(get_db))
     return crud.delete_producer_by_id(db=db, producer_id=producer_id)
 
 # Categories
-@app.get("/categories/", response_model=List[schemas.CategoriesSchema], tags=["Categories"])
-async def get_categories(db: Session = Depends(get_db)):
-    categories = crud.get_categories(db)
+@app.get("/categories/", response_model=List[schemas.CategoriesSchema], tags=["Categories"], dependencies=[Depends(CATEGORIES_ETAG)])
+def get_categories(db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False):
+    if stream:
+        return ndjson_response(db, crud.get_categories, schemas.CategoriesSchema, limit=limit, after=after)
+    categories = crud.get_categories(db, limit=limit, after=after)
     return categories
 
 
-@app.get("/categories/name/{category_name}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def get_category_by_name(category_name: str, db: Session = Depends(get_db)):
+@app.get("/categories/name/{category_name}", response_model=schemas.CategoriesSchema, tags=["Categories"], dependencies=[Depends(CATEGORIES_ETAG)])
+def get_category_by_name(category_name: str, db: Session = Depends(get_read_db)):
     db_category = crud.get_category_by_name(db, name=category_name)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     return db_category
 
 
-@app.get("/categories/id/{category_id}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def get_category_by_id(category_id: int, db: Session = Depends(get_db)):
+@app.get("/categories/id/{category_id}", response_model=schemas.CategoriesSchema, tags=["Categories"], dependencies=[Depends(CATEGORIES_ETAG)])
+def get_category_by_id(category_id: int, db: Session = Depends(get_read_db)):
     db_category = crud.get_category_by_id(db, category_id=category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
@@ -190,39 +454,39 @@ async def get_category_by_id(category_id: int, db: Session = Depends(get_db)):
 
 
 @app.post("/categories/", response_model=schemas.CategoriesSchema, tags=["Categories"], status_code=201)
-async def create_category(category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_name(db, name=category.name)
-    if db_category:
-        raise HTTPException(status_code=400, detail="Category already exists")
-    return crud.create_category(db=db, category=category)
+def create_category(category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
+    db_category = crud.create_category(db=db, category=category)
+    if db_category is None:
+        raise HTTPException(status_code=409, detail="Category already exists")
+    return db_category
 
 
 @app.put("/categories/name/{category_name}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def update_category_by_name(category_name: str, category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_name(db, name=category_name)
+def update_category_by_name(category_name: str, category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
+    db_category = crud.get_category_ref(db, name=category_name)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
-    n_category = db.query(models.Categories).filter(models.Categories.name == category.name).first()
+    n_category = crud.get_category_ref(db, name=category.name)
     if n_category is not None and db_category.name != n_category.name:
-        raise HTTPException(status_code=400, detail="Category already exists")
+        raise HTTPException(status_code=409, detail="Category already exists")
     return crud.update_category_by_name(db=db, name=category_name, category=category)
 
 
 @app.put("/categories/id/{category_id}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def update_category_by_id(category_id: int, category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_id(db, category_id=category_id)
+def update_category_by_id(category_id: int, category: schemas.CategoriesSchema, db: Session = Depends(get_db)):
+    db_category = crud.get_category_ref(db, category_id=category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
-    n_category = db.query(models.Categories).filter(models.Categories.name == category.name).first()
+    n_category = crud.get_category_ref(db, name=category.name)
     if n_category is not None and db_category.name != n_category.name:
-        raise HTTPException(status_code=400, detail="Category already exists")
+        raise HTTPException(status_code=409, detail="Category already exists")
     return crud.update_category_by_id(db=db, category_id=category_id, category=category)
 
 
 
 @app.delete("/categories/name/{category_name}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def delete_category_by_name(category_name: str, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_name(db, name=category_name)
+def delete_category_by_name(category_name: str, db: Session = Depends(get_db)):
+    db_category = crud.get_category_ref(db, name=category_name)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     db_category_ean_devices = db.query(models.EAN_Devices).join(models.Categories).filter(models.Categories.name == category_name).all()
@@ -232,8 +496,8 @@ async def delete_category_by_name(category_name: str, db: Session = Depends(get_
 
 
 @app.delete("/categories/id/{category_id}", response_model=schemas.CategoriesSchema, tags=["Categories"])
-async def delete_category_by_id(category_id: int, db: Session = Depends(get_db)):
-    db_category = crud.get_category_by_id(db, category_id=category_id)
+def delete_category_by_id(category_id: int, db: Session = Depends(get_db)):
+    db_category = crud.get_category_ref(db, category_id=category_id)
     if db_category is None:
         raise HTTPException(status_code=404, detail="Category not found")
     db_category_ean_devices = db.query(models.EAN_Devices).join(models.Categories).filter(models.Categories.category_id == category_id).all()
@@ -242,30 +506,37 @@ async def delete_category_by_id(category_id: int, db: Session = Depends(get_db))
     return crud.delete_category_by_id(db=db, category_id=category_id)
 
 # EAN Devices
-@app.get("/ean_devices/", response_model=List[schemas.EANDevicesSchema], tags=["EAN Devices"])
-async def get_ean_devices(db: Session = Depends(get_db), category_name: Optional[str] = None, producer_name: Optional[str] = None):
-    ean_devices = crud.get_ean_devices(db, category_name, producer_name)
-    return ean_devices
-
-
-@app.get("/ean_devices/model/{ean_device_model}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def get_ean_device_by_model(ean_device_model: str, db: Session = Depends(get_db)):
+@app.get("/ean_devices/", response_model=List[schemas.EANDevicesSchema], tags=["EAN Devices"], dependencies=[Depends(EAN_DEVICES_ETAG)])
+def get_ean_devices(db: Session = Depends(get_read_db), category_name: Optional[str] = None, producer_name: Optional[str] = None,
+                    category_id: Optional[int] = None, producer_id: Optional[int] = None, model: Optional[str] = None,
+                    sort: str = Query("ean_device_id", regex=sort_pattern(crud.EAN_DEVICE_SORT_KEYS)), fields: Optional[str] = None,
+                    limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False):
+    params = dict(category_name=category_name, producer_name=producer_name, category_id=category_id, producer_id=producer_id,
+                  model=model, fields=parse_fields(fields, crud.EAN_DEVICE_FIELDS), sort=sort, limit=limit, after=after)
+    if stream:
+        return ndjson_response(db, crud.get_ean_devices, **params)
+    ean_devices = crud.get_ean_devices(db, **params)
+    return FastJSONResponse(ean_devices)
+
+
+@app.get("/ean_devices/model/{ean_device_model}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"], dependencies=[Depends(EAN_DEVICES_ETAG)])
+def get_ean_device_by_model(ean_device_model: str, db: Session = Depends(get_read_db)):
     db_ean_device = crud.get_ean_device_by_model(db, model=ean_device_model)
     if db_ean_device is None:
         raise HTTPException(status_code=404, detail="EAN Device not found")
     return db_ean_device
 
 
-@app.get("/ean_devices/id/{ean_devices_id}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def get_ean_device_by_id(ean_device_id: int, db: Session = Depends(get_db)):
+@app.get("/ean_devices/id/{ean_devices_id}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"], dependencies=[Depends(EAN_DEVICES_ETAG)])
+def get_ean_device_by_id(ean_device_id: int, db: Session = Depends(get_read_db)):
     db_ean_device = crud.get_ean_device_by_id(db, ean_device_id=ean_device_id)
     if db_ean_device is None:
         raise HTTPException(status_code=404, detail="EAN Device not found")
     return db_ean_device
 
 
-@app.get("/ean_devices/ean/{ean_code}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def get_ean_device_by_ean_code(ean_code: str, db: Session = Depends(get_db)):
+@app.get("/ean_devices/ean/{ean_code}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"], dependencies=[Depends(EAN_DEVICES_ETAG)])
+def get_ean_device_by_ean_code(ean_code: str, db: Session = Depends(get_read_db)):
     db_ean_device = crud.get_device_by_ean_code(db, ean_code=ean_code)
     if db_ean_device is None:
         raise HTTPException(status_code=404, detail="EAN Device not found")
@@ -273,32 +544,32 @@ async def get_ean_device_by_ean_code(ean_code: str, db: Session = Depends(get_db
 
 
 @app.post("/ean_devices/name", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"], status_code=201)
-async def create_ean_device_by_name(ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
+def create_ean_device_by_name(ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
     # print(ean_device)
-    db_ean_device = crud.get_device_by_ean_code(db, ean_code=ean_device.ean)
-    if db_ean_device:
-        raise HTTPException(status_code=400, detail="EAN Device already exists")
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
+    category = crud.get_category_ref(db, name=ean_device.category.name)
     if not category:
         raise HTTPException(status_code=400, detail="Category doesn't exist")
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
+    producer = crud.get_producer_ref(db, name=ean_device.producer.name)
     if not producer:
         raise HTTPException(status_code=400, detail="Producer doesn't exist")
-    return crud.create_ean_device_by_name(db=db, ean_device=ean_device)
+    db_ean_device = crud.create_ean_device_by_name(db=db, ean_device=ean_device)
+    if db_ean_device is None:
+        raise HTTPException(status_code=409, detail="EAN Device already exists")
+    return db_ean_device
 
 
 @app.post("/ean_devices/id", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"], status_code=201)
-async def create_ean_device_by_id(ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
-    db_ean_device = crud.get_device_by_ean_code(db, ean_code=ean_device.ean)
-    if db_ean_device:
-        raise HTTPException(status_code=400, detail="EAN Device already exists")
-    category = db.query(models.Categories).filter(models.Categories.category_id == ean_device.category.category_id).first()
+def create_ean_device_by_id(ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
+    category = crud.get_category_ref(db, category_id=ean_device.category.category_id)
     if not category:
         raise HTTPException(status_code=400, detail="Category doesn't exist")
-    producer = db.query(models.Producers).filter(models.Producers.producer_id == ean_device.producer.producer_id).first()
+    producer = crud.get_producer_ref(db, producer_id=ean_device.producer.producer_id)
     if not producer:
         raise HTTPException(status_code=400, detail="Producer doesn't exist")
-    return crud.create_ean_device_by_id(db=db, ean_device=ean_device)
+    db_ean_device = crud.create_ean_device_by_id(db=db, ean_device=ean_device)
+    if db_ean_device is None:
+        raise HTTPException(status_code=409, detail="EAN Device already exists")
+    return db_ean_device
 
 
 # @app.put("/ean_devices/name/{ean_code}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
@@ -308,7 +579,7 @@ async def create_ean_device_by_id(ean_device: schemas.EANDevicesSchema, db: Sess
 #         raise HTTPException(status_code=404, detail="EAN Device not found")
 #     n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_device.ean).first()
 #     if n_ean_device is not None and n_ean_device.ean != db_ean_device.ean:
-#         raise HTTPException(status_code=400, detail="EAN Device already exists")
+#         raise HTTPException(status_code=409, detail="EAN Device already exists")
 #     category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
 #     if not category:
 #         raise HTTPException(status_code=400, detail="Category doesn't exist")
@@ -321,17 +592,17 @@ async def create_ean_device_by_id(ean_device: schemas.EANDevicesSchema, db: Sess
 #     return n_ean_device
 
 @app.put("/ean_devices/name/{ean_device_id}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def update_ean_device_by_name(ean_device_id: int, ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
+def update_ean_device_by_name(ean_device_id: int, ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
     db_ean_device = crud.get_ean_device_by_id(db, ean_device_id=ean_device_id)
     if db_ean_device is None:
         raise HTTPException(status_code=404, detail="EAN Device not found")
-    n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_device.ean).first()
+    n_ean_device = crud.get_ean_device_ref(db, ean=ean_device.ean)
     if n_ean_device is not None and n_ean_device.ean != db_ean_device.ean:
-        raise HTTPException(status_code=400, detail="EAN Device already exists")
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
+        raise HTTPException(status_code=409, detail="EAN Device already exists")
+    category = crud.get_category_ref(db, name=ean_device.category.name)
     if not category:
         raise HTTPException(status_code=400, detail="Category doesn't exist")
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
+    producer = crud.get_producer_ref(db, name=ean_device.producer.name)
     if not producer:
         raise HTTPException(status_code=400, detail="Producer doesn't exist")
 
@@ -341,17 +612,17 @@ async def update_ean_device_by_name(ean_device_id: int, ean_device: schemas.EAND
 
 
 @app.put("/ean_devices/id/{ean_device_id}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def update_ean_device_by_id(ean_device_id: int, ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
+def update_ean_device_by_id(ean_device_id: int, ean_device: schemas.EANDevicesSchema, db: Session = Depends(get_db)):
     db_ean_device = crud.get_ean_device_by_id(db, ean_device_id=ean_device_id)
     if db_ean_device is None:
         raise HTTPException(status_code=404, detail="EAN Device not found")
-    n_ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == ean_device.ean).first()
+    n_ean_device = crud.get_ean_device_ref(db, ean=ean_device.ean)
     if n_ean_device is not None and n_ean_device.ean != db_ean_device.ean:
-        raise HTTPException(status_code=400, detail="EAN Device already exists")
-    category = db.query(models.Categories).filter(models.Categories.name == ean_device.category.name).first()
+        raise HTTPException(status_code=409, detail="EAN Device already exists")
+    category = crud.get_category_ref(db, name=ean_device.category.name)
     if not category:
         raise HTTPException(status_code=400, detail="Category doesn't exist")
-    producer = db.query(models.Producers).filter(models.Producers.name == ean_device.producer.name).first()
+    producer = crud.get_producer_ref(db, name=ean_device.producer.name)
     if not producer:
         raise HTTPException(status_code=400, detail="Producer doesn't exist")
 
@@ -360,7 +631,7 @@ async def update_ean_device_by_id(ean_device_id: int, ean_device: schemas.EANDev
     return n_ean_device
 
 @app.delete("/ean_devices/name/{ean_device_code}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def delete_ean_device_by_ean(ean_code: str, db: Session = Depends(get_db)):
+def delete_ean_device_by_ean(ean_code: str, db: Session = Depends(get_db)):
     db_ean_device = crud.get_device_by_ean_code(db, ean_code=ean_code)
 
     if db_ean_device is None:
@@ -369,7 +640,7 @@ async def delete_ean_device_by_ean(ean_code: str, db: Session = Depends(get_db))
 
 
 @app.delete("/ean_devices/id/{ean_device_id}", response_model=schemas.EANDevicesSchema, tags=["EAN Devices"])
-async def delete_device_by_id(ean_device_id: int, db: Session = Depends(get_db)):
+def delete_device_by_id(ean_device_id: int, db: Session = Depends(get_db)):
     db_ean_device = crud.get_ean_device_by_id(db, ean_device_id=ean_device_id)
 
     if db_ean_device is None:
@@ -378,209 +649,296 @@ async def delete_device_by_id(ean_device_id: int, db: Session = Depends(get_db))
 
 
 # Devices
-@app.get("/devices/", response_model=List[schemas.DevicesSchema], tags=["Devices"])
-async def get_devices(db: Session = Depends(get_db), location_name: Optional[str] = None, ean_code: Optional[str] = None):
-    devices = crud.get_devices(db, location_name, ean_code)
-    return devices
+@app.get("/devices/", response_model=List[schemas.DevicesSchema], tags=["Devices"], dependencies=[Depends(DEVICES_ETAG)])
+def get_devices(db: Session = Depends(get_read_db), location_name: Optional[str] = None, ean_code: Optional[str] = None,
+                location_id: Optional[int] = None, ean_device_id: Optional[int] = None, category_name: Optional[str] = None,
+                producer_name: Optional[str] = None, status: Optional[List[str]] = Query(None),
+                condition: Optional[List[str]] = Query(None), returned: Optional[bool] = None,
+                date_from: Optional[date] = None, date_to: Optional[date] = None,
+                sort: str = Query("device_id", regex=sort_pattern(crud.DEVICE_SORT_KEYS)), fields: Optional[str] = None,
+                limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False):
+    params = dict(location_name=location_name, ean_code=ean_code, location_id=location_id, ean_device_id=ean_device_id,
+                  category_name=category_name, producer_name=producer_name, status=status, condition=condition,
+                  returned=returned, date_from=date_from, date_to=date_to, fields=parse_fields(fields, crud.DEVICE_FIELDS),
+                  sort=sort, limit=limit, after=after)
+    if stream:
+        return ndjson_response(db, crud.get_devices, **params)
+    devices = crud.get_devices(db, **params)
+    return FastJSONResponse(devices)
 
 @app.get("/devices/name/{device_name}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def get_device_by_name(device_name: str, db: Session = Depends(get_db)):
+def get_device_by_name(device_name: str, request: Request, db: Session = Depends(get_read_db)):
     db_device = crud.get_device_by_name(db, name=device_name)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    set_device_etag(request, db_device)
     return db_device
 
 @app.get("/devices/id/{device_id}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def get_device_by_id(device_id: int, db: Session = Depends(get_db)):
+def get_device_by_id(device_id: int, request: Request, db: Session = Depends(get_read_db)):
     db_device = crud.get_device_by_id(db, device_id=device_id)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    set_device_etag(request, db_device)
     return db_device
 
 @app.get("/devices/qr/{qr_code}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def get_device_by_qr_code(qr_code: str, db: Session = Depends(get_db)):
+def get_device_by_qr_code(qr_code: str, request: Request, db: Session = Depends(get_read_db)):
     db_device = crud.get_device_by_qr_code(db, qr_code=qr_code)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    set_device_etag(request, db_device)
     return db_device
 
 @app.get("/devices/sn/{sn}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def get_device_by_sn(sn: str, db: Session = Depends(get_db)):
+def get_device_by_sn(sn: str, request: Request, db: Session = Depends(get_read_db)):
     db_device = crud.get_device_by_sn(db, serial_number=sn)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
+    set_device_etag(request, db_device)
     return db_device
 
 @app.post("/devices/name", response_model=schemas.DevicesSchema, tags=["Devices"], status_code=201)
-async def create_device_by_name(device: schemas.DevicesSchema, db: Session = Depends(get_db)):
-    db_device = crud.get_device_by_name(db, name=device.name)
-    if db_device:
-        raise HTTPException(status_code=400, detail="Device already exists")
-    location = db.query(models.Locations).filter(models.Locations.name == device.location.name).first()
+def create_device_by_name(device: schemas.DevicesSchema, db: Session = Depends(get_db)):
+    location = crud.get_location_ref(db, name=device.location.name)
     if not location:
         raise HTTPException(status_code=400, detail="Location doesn't exist")
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == device.ean_device.ean).first()
+    ean_device = crud.get_ean_device_ref(db, ean=device.ean_device.ean)
     if not ean_device:
         raise HTTPException(status_code=400, detail="EAN Device doesn't exist")
-    return crud.create_device_by_name(db=db, device=device)
+    db_device = crud.create_device_by_name(db=db, device=device)
+    if db_device is None:
+        raise HTTPException(status_code=409, detail="Device already exists")
+    return db_device
 
 @app.post("/devices/id", response_model=schemas.DevicesSchema, tags=["Devices"], status_code=201)
-async def create_device_by_id(device: schemas.DevicesSchema, db: Session = Depends(get_db)):
-    db_device_id = crud.get_device_by_id(db, device_id=device.device_id)
-    db_device_qr = crud.get_device_by_qr_code(db, qr_code=device.qr_code)
-
-    if device.serial_number != "":
-        db_device_sn = crud.get_device_by_sn(db, serial_number=device.serial_number)
-        if db_device_sn:
-            raise HTTPException(status_code=409, detail="Device already exists")
-
-    if db_device_id or db_device_qr:
-        raise HTTPException(status_code=409, detail="Device already exists")
-    location = db.query(models.Locations).filter(models.Locations.location_id == device.location.location_id).first()
+def create_device_by_id(device: schemas.DevicesSchema, db: Session = Depends(get_db)):
+    location = crud.get_location_ref(db, location_id=device.location.location_id)
     if not location:
         raise HTTPException(status_code=400, detail="Location doesn't exist")
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean_device_id == device.ean_device.ean_device_id).first()
+    ean_device = crud.get_ean_device_ref(db, ean_device_id=device.ean_device.ean_device_id)
     if not ean_device:
         raise HTTPException(status_code=400, detail="EAN Device doesn't exist")
     # print(device)
-    return crud.create_device_by_id(db=db, device=device)
+    db_device = crud.create_device_by_id(db=db, device=device)
+    if db_device is None:
+        raise HTTPException(status_code=409, detail="Device already exists")
+    return db_device
 
-@app.put("/devices/name/{device_name}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def update_device_by_name(device_name: str, device: schemas.DevicesSchema, db: Session = Depends(get_db)):
-    db_device = crud.get_device_by_name(db, name=device_name)
-    old_location_id = db_device.location_id
-    old_location_name = db_device.location.name
-    old_quantity = db_device.quantity
-    old_returned = db_device.returned
-    old_status = db_device.status
+@app.post("/devices/bulk", response_model=schemas.DeviceImportReportSchema, tags=["Devices"])
+async def create_devices_bulk(request: Request, db: Session = Depends(get_db)):
+    content_type = request.headers.get('content-type', 'application/json').split(';')[0].strip()
+    body = await request.body()
+    try:
+        rows = await run_in_threadpool(parse_device_import, content_type, body)
+    except (ValueError, csv.Error) as error:
+        # UnicodeDecodeError and JSONDecodeError are ValueErrors
+        raise HTTPException(status_code=400, detail=f"Invalid import file: {error}")
+    try:
+        return await run_in_threadpool(crud.create_devices_bulk, db, rows)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Devices were created concurrently, retry the import")
+    except (DataError, psycopg2.DataError):
+        # Values DeviceImportSchema lets through but the columns don't take; the COPY runs on the DBAPI cursor
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Invalid import file: a value doesn't fit its column")
 
-    if db_device is None:
-        raise HTTPException(status_code=404, detail="Device not found")
-    n_device = db.query(models.Devices).filter(models.Devices.device_id == device.device_id).first()
-    if n_device is not None and n_device.name != db_device.name:
-        raise HTTPException(status_code=400, detail="Device already exists")
-    location = db.query(models.Locations).filter(models.Locations.name == device.location.name).first()
+@app.put("/devices/name/{device_name}", response_model=schemas.DevicesSchema, tags=["Devices"])
+def update_device_by_name(device_name: str, device: schemas.DevicesSchema, request: Request, db: Session = Depends(get_db),
+                          if_match: Optional[str] = Header(None)):
+    location = crud.get_location_ref(db, name=device.location.name)
     if not location:
         raise HTTPException(status_code=400, detail="Location doesn't exist")
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == device.ean_device.ean).first()
+    ean_device = crud.get_ean_device_ref(db, ean=device.ean_device.ean)
     if not ean_device:
         raise HTTPException(status_code=400, detail="EAN Device doesn't exist")
-
-    n_device = crud.update_device_by_name(db=db, name=device_name, device=device)
-
-    # TODO
-    if old_location_id != n_device.location_id:
-        crud.create_device_history(db,
-                                   event=f'Zmiana lokalizacji urządzenia: {old_location_name} -> {n_device.location.name}',
-                                   device=n_device)
-    if old_quantity != n_device.quantity:
-        crud.create_device_history(db,
-                                   event=f'Zmiana ilości sztuk: {old_quantity} -> {n_device.quantity}',
-                                   device=n_device)
-    if old_returned != n_device.returned:
-        crud.create_device_history(db,
-                                   event=f'Zarejestrowano zwrot urządzenia (ID: {n_device.qr_code}',
-                                   device=n_device)
-
-    if old_status != n_device.status:
-        crud.create_device_history(db, event=f'Zmiana statusu urządzenia: {old_status} -> {n_device.status}',
-                                   device=n_device)
-
-    return n_device
+    version = expected_version(if_match, device)
+    db_device = crud.update_device_by_name(db=db, name=device_name, device=device, version=version)
+    if db_device is None:
+        raise device_update_error(crud.get_device_by_name(db, name=device_name), version)
+    set_device_etag(request, db_device)
+    return db_device
 
 @app.put("/devices/id/{device_id}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def update_device_by_id(device_id: int, device: schemas.DevicesSchema, db: Session = Depends(get_db)):
-    db_device = crud.get_device_by_id(db, device_id=device_id)
-    old_location_id = db_device.location_id
-    old_location_name = db_device.location.name
-    old_quantity = db_device.quantity
-    old_returned = db_device.returned
-    old_status = db_device.status
-    if db_device is None:
-        raise HTTPException(status_code=404, detail="Device not found")
-    n_device = db.query(models.Devices).filter(models.Devices.device_id == device.device_id).first()
-    if n_device is not None and n_device.name != db_device.name:
-        raise HTTPException(status_code=400, detail="Device already exists")
-    location = db.query(models.Locations).filter(models.Locations.location_id == device.location.location_id).first()
+def update_device_by_id(device_id: int, device: schemas.DevicesSchema, request: Request, db: Session = Depends(get_db),
+                        if_match: Optional[str] = Header(None)):
+    location = crud.get_location_ref(db, location_id=device.location.location_id)
     if not location:
         raise HTTPException(status_code=400, detail="Location doesn't exist")
-    ean_device = db.query(models.EAN_Devices).filter(models.EAN_Devices.ean == device.ean_device.ean).first()
+    ean_device = crud.get_ean_device_ref(db, ean_device_id=device.ean_device.ean_device_id)
     if not ean_device:
         raise HTTPException(status_code=400, detail="EAN Device doesn't exist")
-
-    n_device = crud.update_device_by_id(db=db, device_id=device_id, device=device)
-    # TODO
-    if old_location_id != n_device.location_id:
-        crud.create_device_history(db,
-                                   event=f'Zmiana lokalizacji urządzenia: {old_location_name} -> {n_device.location.name}',
-                                   device=n_device)
-    if old_quantity != n_device.quantity:
-        crud.create_device_history(db,
-                                   event=f'Zmiana ilości sztuk: {old_quantity} -> {n_device.quantity}',
-                                   device=n_device)
-    if old_returned != n_device.returned:
-        crud.create_device_history(db,
-                                   event=f'Zarejestrowano zwrot urządzenia (ID: {n_device.qr_code})',
-                                   device=n_device)
-
-    if old_status != n_device.status:
-        crud.create_device_history(db, event=f'Zmiana statusu urządzenia: {old_status} -> {n_device.status}',
-                                   device=n_device)
-
-    return n_device
+    version = expected_version(if_match, device)
+    db_device = crud.update_device_by_id(db=db, device_id=device_id, device=device, version=version)
+    if db_device is None:
+        raise device_update_error(crud.get_device_by_id(db, device_id=device_id), version)
+    set_device_etag(request, db_device)
+    return db_device
 
 @app.delete("/devices/name/{device_name}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def delete_device_by_name(device_name: str, db: Session = Depends(get_db)):
-    db_device = crud.get_device_by_name(db, name=device_name)
-    # TODO
-    crud.delete_device_history_by_name(db, name=device_name)
-    # crud.delete_verification_device_link(db, device_id=db_device.device_id)
+def delete_device_by_name(device_name: str, db: Session = Depends(get_db)):
+    db_device = crud.delete_device_by_name(db=db, name=device_name)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
-    return crud.delete_device_by_name(db=db, name=device_name)
+    return db_device
 
 
 @app.delete("/devices/id/{device_id}", response_model=schemas.DevicesSchema, tags=["Devices"])
-async def delete_device_by_id(device_id: int, db: Session = Depends(get_db)):
-    db_device = crud.get_device_by_id(db, device_id=device_id)
-    # TODO
-    crud.delete_device_history_by_name(db, name=db_device.name)
-    # crud.delete_verification_device_link(db, device_id=db_device.device_id)
+def delete_device_by_id(device_id: int, db: Session = Depends(get_db)):
+    db_device = crud.delete_device_by_id(db=db, device_id=device_id)
     if db_device is None:
         raise HTTPException(status_code=404, detail="Device not found")
-    return crud.delete_device_by_id(db=db, device_id=device_id)
+    return db_device
+
+
+@app.post("/devices/bulk/delete", response_model=schemas.DeviceDeleteReportSchema, tags=["Devices"])
+def delete_devices(device_ids: List[int], db: Session = Depends(get_db)):
+    deleted = crud.delete_devices(db, device_ids)
+    return schemas.DeviceDeleteReportSchema(deleted=deleted, not_found=sorted(set(device_ids) - set(deleted)))
 
 # DeviceHistories
-@app.get("/deviceshistories/", response_model=List[schemas.DeviceHistoriesSchema], tags=["DeviceHistories"])
-async def get_devices_histories(db: Session = Depends(get_db)):
-    devices_histories = crud.get_devices_histories(db)
-    return devices_histories
+DeviceHistoriesResponse = Union[schemas.CompactDeviceHistoriesSchema, List[schemas.DeviceHistoriesSchema]]
+EXPAND = Query(None, regex="^device$")
+
 
+@app.get("/deviceshistories/", response_model=DeviceHistoriesResponse, tags=["DeviceHistories"], dependencies=[Depends(DEVICE_HISTORIES_ETAG)])
+def get_devices_histories(db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False,
+                          expand: Optional[str] = EXPAND, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    return device_histories_response(db, crud.get_devices_histories, expand, stream, limit=limit, after=after,
+                                     date_from=date_from, date_to=date_to)
 
-@app.get("/deviceshistories/{device_name}", response_model=List[schemas.DeviceHistoriesSchema], tags=["DeviceHistories"])
-async def get_device_histories_by_name(device_name: str, db: Session = Depends(get_db)):
-    db_device_history = crud.get_device_histories_by_name(db, name=device_name)
-    if db_device_history is None:
-        raise HTTPException(status_code=404, detail=f"History not found for {device_name}")
-    return db_device_history
 
-@app.get("/deviceshistories/id/{device_id}", response_model=List[schemas.DeviceHistoriesSchema], tags=["DeviceHistories"])
-async def get_device_histories_by_id(device_id: int, db: Session = Depends(get_db)):
-    db_device_history = crud.get_device_histories_by_id(db, device_id)
-    if db_device_history is None:
-        raise HTTPException(status_code=404, detail=f"History not found for device with id {device_id}")
-    return db_device_history
+@app.get("/deviceshistories/{device_name}", response_model=DeviceHistoriesResponse, tags=["DeviceHistories"], dependencies=[Depends(DEVICE_HISTORIES_ETAG)])
+def get_device_histories_by_name(device_name: str, db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False,
+                                 expand: Optional[str] = EXPAND, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    return device_histories_response(db, crud.get_device_histories_by_name, expand, stream, name=device_name,
+                                     limit=limit, after=after, date_from=date_from, date_to=date_to)
+
+@app.get("/deviceshistories/id/{device_id}", response_model=DeviceHistoriesResponse, tags=["DeviceHistories"], dependencies=[Depends(DEVICE_HISTORIES_ETAG)])
+def get_device_histories_by_id(device_id: int, db: Session = Depends(get_read_db), limit: Optional[int] = Query(None, ge=1), after: Optional[int] = None, stream: bool = False,
+                               expand: Optional[str] = EXPAND, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None):
+    return device_histories_response(db, crud.get_device_histories_by_id, expand, stream, device_id=device_id,
+                                     limit=limit, after=after, date_from=date_from, date_to=date_to)
 
 
 @app.post("/deviceshistories/", response_model=schemas.DeviceHistoriesSchema, tags=["DeviceHistories"], status_code=201)
-async def create_device_history(device_history: schemas.DeviceHistoriesSchema, db: Session = Depends(get_db)):
+def create_device_history(device_history: schemas.DeviceHistoriesSchema, db: Session = Depends(get_db)):
     device = db.query(models.Devices).filter(models.Devices.device_id == device_history.device.device_id).first()
     if not device:
         raise HTTPException(status_code=404, detail="Device doesn't exist")
     # user = db.query(models.Users).filter(models.Users.username == device_history.user.username).first()
     # if not user:
     #     raise HTTPException(status_code=404, detail="User doesn't exist")
-    return crud.create_device_history(db=db, device_history=device_history)
+    return crud.create_device_history(db=db, event=device_history.event, device=device)
+
+
+def read_history_events(after, device_ids, location_ids):
+    # The feed reads from the primary: notifications come from there, a replica may not have the rows yet
+    db = SessionLocal()
+    try:
+        if after is None:
+            return crud.get_history_cursor(db), []
+        return after, crud.get_device_history_events(db, after, device_ids, location_ids, limit=FEED_BATCH_SIZE)
+    finally:
+        db.close()
+
+
+@app.get("/feed/deviceshistories", tags=["DeviceHistories"])
+async def get_device_histories_feed(request: Request, device_id: Optional[List[int]] = Query(None),
+                                    location_id: Optional[List[int]] = Query(None),
+                                    after: Optional[str] = Query(None, regex=crud.HISTORY_CURSOR_PATTERN)):
+    # Server-Sent Events with every new history event, optionally only for some devices or locations.
+    # Resumes after the ?after= cursor or the Last-Event-ID sent by a reconnecting EventSource, otherwise starts
+    # from now. Event ids are history cursors, not history_ids
+    last_event_id = request.headers.get("last-event-id", "")
+    if after is None and re.match(crud.HISTORY_CURSOR_PATTERN, last_event_id):
+        after = last_event_id
+
+    async def events(after):
+        subscription = history_feed.subscribe()
+        try:
+            while True:
+                after, rows = await run_in_threadpool(read_history_events, after, device_id, location_id)
+                for after, row in rows:
+                    yield b"id: %s\nevent: history\ndata: %s\n\n" % (after.encode(), dumps(row))
+                if len(rows) == FEED_BATCH_SIZE:
+                    continue
+                if not await subscription.wait(FEED_HEARTBEAT):
+                    yield b": heartbeat\n\n"
+        finally:
+            history_feed.unsubscribe(subscription)
+    return StreamingResponse(events(after), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Stock
+@app.get("/stock/", tags=["Stock"], dependencies=[Depends(DEVICES_ETAG)])
+def get_stock_levels(db: Session = Depends(get_read_db), group_by: str = "location", location_id: Optional[int] = None,
+                     ean_device_id: Optional[int] = None, category_id: Optional[int] = None, producer_id: Optional[int] = None,
+                     status: Optional[List[str]] = Query(None), returned: Optional[bool] = None):
+    # Number of devices and summed quantity per group, e.g. ?group_by=location,category,status
+    groups = parse_fields(group_by, crud.STOCK_GROUPS)
+    return FastJSONResponse(crud.get_stock_levels(db, groups, location_id=location_id, ean_device_id=ean_device_id,
+                                                  category_id=category_id, producer_id=producer_id, status=status,
+                                                  returned=returned))
+
+
+@app.post("/stock/rebuild", tags=["Stock"])
+def rebuild_stock_levels(db: Session = Depends(get_db)):
+    return {"groups": crud.rebuild_stock_levels(db)}
+
+
+# Search
+@app.get("/search/", response_model=schemas.SearchResultSchema, tags=["Search"], dependencies=[Depends(DEVICES_ETAG)])
+def search(q: str = Query(..., min_length=3), limit: int = Query(20, ge=1, le=100), db: Session = Depends(get_read_db)):
+    # Devices by name, serial number or description and EAN devices by model, ranked by similarity to q.
+    # Three characters at least, shorter strings have no trigrams to look up in the indexes
+    return FastJSONResponse(crud.search(db, q, limit))
+
+
+# Scan
+@app.post("/scan/resolve", response_model=schemas.ScanResultSchema, tags=["Scan"])
+def resolve_scanned_codes(scan: schemas.ScanSchema, db: Session = Depends(get_read_db)):
+    # A whole pallet scan in one request: results keyed by code, codes resolving to nothing listed in misses
+    results = crud.resolve_scanned_codes(db, qr_codes=scan.codes + scan.qr_codes,
+                                         serial_numbers=scan.codes + scan.serial_numbers, eans=scan.codes + scan.eans)
+    codes = dict.fromkeys(scan.codes + scan.qr_codes + scan.serial_numbers + scan.eans)
+    return FastJSONResponse({"results": results, "misses": [code for code in codes if code not in results]})
+
+
+# Sync
+@app.get("/sync/devices", response_model=schemas.DeviceSyncSchema, tags=["Sync"])
+def sync_devices(db: Session = Depends(get_read_db), since: Optional[str] = Query(None, regex=crud.HISTORY_CURSOR_PATTERN), since_time: Optional[datetime] = None,
+                 limit: int = Query(SYNC_PAGE_SIZE, ge=1, le=10 * SYNC_PAGE_SIZE), events: bool = True):
+    # Changes after a history cursor, or after a timestamp on the first sync. The devices are listed once each, in
+    # their current state, followed by the ids of deleted devices; clients store the returned cursor and call again
+    # while has_more is true
+    if since is None:
+        if since_time is None:
+            raise HTTPException(status_code=400, detail="Either since or since_time is required")
+        since = crud.get_history_cursor_before(db, since_time)
+    return FastJSONResponse(crud.sync_devices(db, since, limit, events))
+
+
+# Status
+@app.get("/status/cache", tags=["Status"])
+def get_cache_status():
+    return crud.reference_cache.stats()
+
+
+@app.get("/status/pool", tags=["Status"])
+def get_pool_status():
+    return {'primary': pool_status(engine), 'replica': pool_status(replica_engine) if replica_engine is not None else None}
+
+
+@app.get("/metrics", tags=["Status"], response_class=Response)
+def get_metrics():
+    # Prometheus scrape target: per-route latency, SQL statements and DB time, and the connection pools
+    pools = {'primary': pool_status(engine)}
+    if replica_engine is not None:
+        pools['replica'] = pool_status(replica_engine)
+    return Response(metrics.render(pools), media_type=metrics.CONTENT_TYPE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,217 @@
+import threading
+import time
+from contextvars import ContextVar
+from sqlalchemy import event
+
+# Request latency, SQL statements and DB time per route, in the Prometheus text exposition format.
+# Routes are labelled with their path template, so path parameters don't multiply the series
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+CONTENT_TYPE = "text/plain; version=0.0.4"
+UNMATCHED_ROUTE = "unmatched"
+
+
+class RequestStats:
+    # SQL work of one request, shared by every thread and task the request runs in
+    def __init__(self, scope):
+        self.scope = scope
+        self.statements = 0
+        self.db_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, elapsed):
+        with self._lock:
+            self.statements += 1
+            self.db_time += elapsed
+
+
+_request_stats = ContextVar("request_stats", default=None)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join('{0}="{1}"'.format(name, escape(value)) for name, value in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} counter".format(self.name)]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append("{0}{1} {2}".format(self.name, _labels(self.labelnames, labels), _number(value)))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float("inf"),)
+        # labels -> [count per bucket, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        with self._lock:
+            counts, total, count = self._values.get(labels) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} histogram".format(self.name)]
+        names = self.labelnames + ("le",)
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append("{0}_bucket{1} {2}".format(self.name, _labels(names, labels + (_number(bound),)), cumulative))
+                lines.append("{0}_sum{1} {2}".format(self.name, _labels(self.labelnames, labels), _number(total)))
+                lines.append("{0}_count{1} {2}".format(self.name, _labels(self.labelnames, labels), count))
+        return lines
+
+
+REQUEST_LABELS = ("method", "route")
+REQUESTS = Counter("inventory_http_requests_total", "HTTP requests by route and status code.",
+                   REQUEST_LABELS + ("status",))
+REQUEST_DURATION = Histogram("inventory_http_request_duration_seconds", "Time to produce the response head.",
+                             REQUEST_LABELS)
+REQUEST_STATEMENTS = Histogram("inventory_http_request_db_statements", "SQL statements executed per request.",
+                               REQUEST_LABELS, STATEMENT_BUCKETS)
+REQUEST_DB_DURATION = Histogram("inventory_http_request_db_duration_seconds", "Time spent in SQL per request.",
+                                REQUEST_LABELS)
+STATEMENTS = Counter("inventory_db_statements_total", "SQL statements executed, in requests or not.")
+DB_DURATION = Counter("inventory_db_duration_seconds_total", "Time spent in SQL, in requests or not.")
+METRICS = (REQUESTS, REQUEST_DURATION, REQUEST_STATEMENTS, REQUEST_DB_DURATION, STATEMENTS, DB_DURATION)
+
+
+def record_statement(elapsed):
+    # Charges a statement to the totals and to the request being served, if any. Called by the engine events, and
+    # directly for work the events don't see, i.e. a COPY on the DBAPI cursor
+    STATEMENTS.inc()
+    DB_DURATION.inc(amount=elapsed)
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.add(elapsed)
+
+
+def instrument_engine(db_engine):
+    # Times every statement of the engine and charges it to the request being served, if any
+    @event.listens_for(db_engine, "before_cursor_execute")
+    def start_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(db_engine, "after_cursor_execute")
+    def stop_timer(conn, cursor, statement, parameters, context, executemany):
+        record_statement(time.perf_counter() - conn.info["query_start"].pop())
+
+    @event.listens_for(db_engine, "handle_error")
+    def drop_timer(context):
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+
+def route_label(scope):
+    route = scope.get("route")
+    return getattr(route, "path", UNMATCHED_ROUTE)
+
+
+def current_route():
+    # "GET /devices/id/{device_id}" for statements run while serving a request, None outside requests
+    stats = _request_stats.get()
+    if stats is None:
+        return None
+    return "{0} {1}".format(stats.scope["method"], route_label(stats.scope))
+
+
+def server_timing(stats, elapsed):
+    return 'db;dur={0:.1f};desc="{1} statements", app;dur={2:.1f}'.format(
+        stats.db_time * 1000, stats.statements, elapsed * 1000)
+
+
+class MetricsMiddleware:
+    # Pure ASGI middleware, outermost: times the request up to its response head, which then carries a
+    # Server-Timing header. Statements a streaming body runs after the head are in the totals only
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        start = time.perf_counter()
+        started = False
+
+        def record(status_code):
+            elapsed = time.perf_counter() - start
+            labels = (scope["method"], route_label(scope))
+            REQUESTS.inc(labels + (str(status_code),))
+            REQUEST_DURATION.observe(elapsed, labels)
+            REQUEST_STATEMENTS.observe(stats.statements, labels)
+            REQUEST_DB_DURATION.observe(stats.db_time, labels)
+            return elapsed
+
+        async def send_with_timing(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                elapsed = record(message["status"])
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", server_timing(stats, elapsed).encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        except Exception:
+            # Unhandled errors are answered with a 500 by Starlette's outer error middleware
+            if not started:
+                record(500)
+            raise
+        finally:
+            _request_stats.reset(token)
+
+
+def pool_lines(pools):
+    # Connection pool gauges and counters, pools maps an engine label to database.pool_status()
+    lines = []
+    for key, kind in (("size", "gauge"), ("checked_out", "gauge"), ("overflow", "gauge"), ("checkouts", "counter"),
+                      ("timeouts", "counter"), ("wait_seconds_total", "counter")):
+        name = "inventory_db_pool_" + key + ("_total" if kind == "counter" and not key.endswith("_total") else "")
+        lines.append("# TYPE {0} {1}".format(name, kind))
+        for engine_name, status in pools.items():
+            lines.append("{0}{1} {2}".format(name, _labels(("engine",), (engine_name,)), _number(status[key])))
+    return lines
+
+
+def render(pools=None):
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(pool_lines(pools or {}))
+    return "\n".join(lines) + "\n"
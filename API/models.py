@@ -1,7 +1,19 @@
-from sqlalchemy import Date, Column, ForeignKey, Integer, String, TIMESTAMP, BOOLEAN
+from sqlalchemy import BigInteger, DDL, Date, Column, ForeignKey, Index, Integer, LargeBinary, String, TIMESTAMP, BOOLEAN, event, func, text
 from sqlalchemy.orm import relationship
 from .database import Base
 
+# Trigram operators and GIN operator classes behind the search indexes
+event.listen(Base.metadata, 'before_create', DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+
+# The 64 bit id of the writing transaction. Rows are delivered to syncing clients only once every transaction older
+# than theirs has finished, see crud.get_device_history_events
+CURRENT_TRANSACTION_ID = text("(pg_current_xact_id()::text::bigint)")
+
+
+def trigram_index(name, column):
+    return Index(name, column, postgresql_using='gin', postgresql_ops={column: 'gin_trgm_ops'})
+
 
 class Locations(Base):
     __tablename__ = "locations"
@@ -13,46 +25,63 @@ class Producers(Base):
     __tablename__ = "producers"
     producer_id = Column(Integer, primary_key=True, index=True)
     name = Column(String)
+    __table_args__ = (Index('uq_producers_name', 'name', unique=True),)
     ean_device = relationship('EAN_Devices', back_populates="producer")
 
 class Categories(Base):
     __tablename__ = "categories"
     category_id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
+    name = Column(String, unique=True)
     ean_device = relationship('EAN_Devices', back_populates="category")
 
 class EAN_Devices(Base):
     __tablename__ = "ean_devices"
     ean_device_id = Column(Integer, primary_key=True, index=True)
-    ean = Column(String)
+    ean = Column(String, unique=True)
     category_id = Column(Integer, ForeignKey('categories.category_id'))
     producer_id = Column(Integer, ForeignKey('producers.producer_id'))
-    model = Column(String)
+    model = Column(String, unique=True)
+    __table_args__ = (trigram_index('ix_ean_devices_model_trgm', 'model'),)
 
-    producer = relationship('Producers', back_populates='ean_device', lazy='subquery')
-    category = relationship('Categories', back_populates='ean_device', lazy='subquery')
+    producer = relationship('Producers', back_populates='ean_device')
+    category = relationship('Categories', back_populates='ean_device')
 
     devices = relationship('Devices', back_populates="ean_device")
 
 class Devices(Base):
     __tablename__ = "devices"
     device_id = Column(Integer, primary_key=True, index=True)
-    name = Column(String)
+    name = Column(String, index=True)
     serial_number = Column(String)
     description = Column(String)
 
-    ean_device_id = Column(Integer, ForeignKey('ean_devices.ean_device_id'))
-    location_id = Column(Integer, ForeignKey('locations.location_id'))
+    ean_device_id = Column(Integer, ForeignKey('ean_devices.ean_device_id'), index=True)
+    location_id = Column(Integer, ForeignKey('locations.location_id'), index=True)
     quantity = Column(Integer)
     condition = Column(String)
     status = Column(String)
     date_added = Column(Date)
     qr_code = Column(String)
     returned = Column(BOOLEAN)
+    # Incremented by every update, PUTs may require the version the client read (optimistic concurrency)
+    version = Column(Integer, nullable=False, default=1, server_default=text('1'))
+    __table_args__ = (
+        # Devices without a serial number are stored with an empty string
+        Index('uq_devices_serial_number', 'serial_number', unique=True, postgresql_where=text("serial_number <> ''")),
+        Index('uq_devices_qr_code', 'qr_code', unique=True),
+        # Sort keys of GET /devices/, the primary key breaks ties for keyset pagination
+        Index('ix_devices_name_device_id', text("coalesce(name, '')"), 'device_id'),
+        Index('ix_devices_date_added_device_id', 'date_added', 'device_id'),
+        Index('ix_devices_status_device_id', 'status', 'device_id'),
+        # GET /search/
+        trigram_index('ix_devices_name_trgm', 'name'),
+        trigram_index('ix_devices_serial_number_trgm', 'serial_number'),
+        trigram_index('ix_devices_description_trgm', 'description'),
+    )
 
-    location = relationship('Locations', back_populates='devices', lazy='subquery')
-    ean_device = relationship('EAN_Devices', back_populates='devices', lazy='subquery')
-    history = relationship('Device_histories', back_populates='device')
+    location = relationship('Locations', back_populates='devices')
+    ean_device = relationship('EAN_Devices', back_populates='devices')
+    history = relationship('Device_histories', back_populates='device', passive_deletes=True)
 
 
 # class Users(Base):
@@ -66,12 +95,63 @@ class Devices(Base):
 
 
 class Device_histories(Base):
+    # Range partitioned by date, the monthly partitions are created by API.partitions
     __tablename__ = "device_histories"
-    history_id = Column(Integer, primary_key=True, index=True)
+    history_id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     event = Column(String)
-    device_id = Column(Integer, ForeignKey('devices.device_id'))
-    date = Column(TIMESTAMP)
+    device_id = Column(Integer, ForeignKey('devices.device_id', ondelete='CASCADE'))
+    # The partition key has to be part of the primary key
+    date = Column(TIMESTAMP, primary_key=True)
+    transaction_id = Column(BigInteger, nullable=False, server_default=CURRENT_TRANSACTION_ID)
+    __table_args__ = (
+        Index('ix_device_histories_device_id_date', 'device_id', 'date'),
+        # Cursors of the change feed and of GET /sync/devices
+        Index('ix_device_histories_transaction_id_history_id', 'transaction_id', 'history_id'),
+        # Timestamp cursors of GET /sync/devices
+        Index('ix_device_histories_date', 'date'),
+        {'postgresql_partition_by': 'RANGE (date)'},
+    )
     # user_id = Column(Integer, ForeignKey('users.user_id'))
 
-    # user = relationship('Users', back_populates='devices_history', lazy='subquery')
-    device = relationship('Devices', back_populates='history', lazy='subquery')
\ No newline at end of file
+    # user = relationship('Users', back_populates='devices_history')
+    device = relationship('Devices', back_populates='history')
+
+
+class Device_tombstones(Base):
+    # Deleted devices, kept after the device and its history are gone so syncing clients learn about the deletion
+    __tablename__ = "device_tombstones"
+    device_id = Column(Integer, primary_key=True)
+    transaction_id = Column(BigInteger, nullable=False, server_default=CURRENT_TRANSACTION_ID, index=True)
+    date = Column(TIMESTAMP, nullable=False, server_default=func.now())
+
+
+class Stock_levels(Base):
+    # Number of devices and their summed quantity per location, EAN device, status and returned flag.
+    # Maintained by crud in the transaction of every device write; no foreign keys, groups of deleted
+    # references are left at zero
+    __tablename__ = "stock_levels"
+    location_id = Column(Integer, primary_key=True)
+    ean_device_id = Column(Integer, primary_key=True)
+    status = Column(String, primary_key=True)
+    returned = Column(BOOLEAN, primary_key=True)
+    devices = Column(Integer, nullable=False, default=0)
+    quantity = Column(BigInteger, nullable=False, default=0)
+
+
+class Table_versions(Base):
+    # Change counter per table, bumped by every write to it; the GET routes build their ETags from it
+    __tablename__ = "table_versions"
+    table_name = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
+
+
+class Idempotency_keys(Base):
+    # Responses of writes sent with an Idempotency-Key header, replayed when the same request is retried.
+    # A row without a status_code is a request still being executed
+    __tablename__ = "idempotency_keys"
+    key = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)
+    status_code = Column(Integer)
+    content_type = Column(String)
+    body = Column(LargeBinary)
+    created_at = Column(TIMESTAMP, nullable=False, server_default=func.now(), index=True)
@@ -0,0 +1,228 @@
+import gzip
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date
+from psycopg2 import errorcodes
+from sqlalchemy import exc, text
+from API.database import get_setting
+import API.models as models
+
+logger = logging.getLogger(__name__)
+
+# device_histories is range partitioned by date, one partition per month plus a default partition catching
+# anything outside them. The [history] section of database.ini configures how far ahead partitions are created,
+# after how many months they are archived (0 keeps them forever) and where the archives are written
+PARENT = 'device_histories'
+DEFAULT_PARTITION = PARENT + '_default'
+MONTHS_AHEAD = get_setting('history', 'partition_months_ahead', 3, int)
+RETENTION_MONTHS = get_setting('history', 'retention_months', 0, int)
+ARCHIVE_DIR = get_setting('history', 'archive_dir', 'history_archive')
+MAINTENANCE_INTERVAL = get_setting('history', 'maintenance_interval', 86400.0, float)
+# Detaching a partition locks device_histories ACCESS EXCLUSIVE. Given up after this many ms instead of queueing every
+# history read and write behind a long running query; the partition is archived on a later run
+LOCK_TIMEOUT = get_setting('history', 'lock_timeout', 5000, int)
+# Serialize maintenance between API processes sharing the database
+MAINTENANCE_LOCK = 4_711_018
+ARCHIVE_LOCK = 4_711_019
+
+_PARTITION_NAME = re.compile(r'^{0}_(\d{{4}})_(\d{{2}})$'.format(PARENT))
+
+
+def add_months(month, months):
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return '{0}_{1:%Y_%m}'.format(PARENT, month)
+
+
+def partition_commands(first_month, last_month):
+    # Monthly partitions from first_month to last_month inclusive, and the default partition
+    commands = ["CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} DEFAULT".format(DEFAULT_PARTITION, PARENT)]
+    month = first_month
+    while month <= last_month:
+        commands.append("CREATE TABLE IF NOT EXISTS {0} PARTITION OF {1} FOR VALUES FROM ('{2}') TO ('{3}')".format(
+            partition_name(month), PARENT, month, add_months(month, 1)))
+        month = add_months(month, 1)
+    return commands
+
+
+def list_partitions(connection):
+    # Monthly partitions currently attached, as (first day of the month, name), oldest first
+    names = connection.execute(text("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                                    "WHERE i.inhparent = CAST(:parent AS regclass)"), {'parent': PARENT}).scalars()
+    partitions = []
+    for name in names:
+        match = _PARTITION_NAME.match(name)
+        if match:
+            partitions.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(partitions)
+
+
+def ensure_partitions(db_engine, today=None):
+    # The current month and MONTHS_AHEAD months after it always have a partition
+    month = (today or date.today()).replace(day=1)
+    with db_engine.begin() as connection:
+        connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MAINTENANCE_LOCK})
+        for command in partition_commands(month, add_months(month, MONTHS_AHEAD)):
+            connection.execute(text(command))
+
+
+def is_partitioned(connection):
+    return connection.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = CAST(:parent AS regclass)"),
+                              {'parent': PARENT}).scalar()
+
+
+def partition_existing_table(db_engine, today=None):
+    # Converts a device_histories table created before partitioning, keeping its rows in place. The table becomes
+    # the partition of everything up to the end of the current month, named like that month's partition, so
+    # retention archives it as a whole once the month has expired. Its indexes are built CONCURRENTLY and its date
+    # bound is checked by a constraint validated beforehand: the swap itself only holds ACCESS EXCLUSIVE for catalog
+    # changes, no scan. Returns False when the table already is partitioned
+    month = (today or date.today()).replace(day=1)
+    partition, bound = partition_name(month), add_months(month, 1)
+    table = models.Device_histories.__table__
+    with db_engine.begin() as connection:
+        if is_partitioned(connection):
+            return False
+        existing = set(connection.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :parent"),
+                                          {'parent': PARENT}).scalars())
+    # The partitioned table's primary key has to include the partition key
+    indexes = [(True, partition + '_pkey', ('history_id', 'date'))] + [
+        (index.unique, index.name.replace(PARENT, partition), tuple(column.name for column in index.columns))
+        for index in table.indexes if index.name not in existing]
+    check = partition + '_bound'
+    with db_engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text("ALTER TABLE {0} ADD COLUMN IF NOT EXISTS transaction_id BIGINT NOT NULL DEFAULT 0"
+                                .format(PARENT)))
+        for unique, name, columns in indexes:
+            try:
+                connection.execute(text("CREATE {0}INDEX CONCURRENTLY IF NOT EXISTS {1} ON {2} ({3})".format(
+                    "UNIQUE " if unique else "", name, PARENT, ", ".join(columns))))
+            except exc.DBAPIError:
+                # An interrupted build leaves an INVALID index behind, a rerun builds it again
+                connection.execute(text("DROP INDEX CONCURRENTLY IF EXISTS {0}".format(name)))
+                raise
+        # Validated without blocking writes, then lets SET NOT NULL and ATTACH PARTITION skip their scans
+        connection.execute(text("ALTER TABLE {0} DROP CONSTRAINT IF EXISTS {1}".format(PARENT, check)))
+        connection.execute(text("ALTER TABLE {0} ADD CONSTRAINT {1} CHECK (date IS NOT NULL AND date < '{2}') NOT VALID"
+                                .format(PARENT, check, bound)))
+        connection.execute(text("ALTER TABLE {0} VALIDATE CONSTRAINT {1}".format(PARENT, check)))
+        # The device_id foreign key as the partitioned table defines it, cascading, so deletes behave the same in
+        # every partition; ATTACH PARTITION reuses it instead of keeping the old one. Added and validated before the
+        # old one is dropped, so the table is never without it
+        foreign_key = partition + '_device_id_fkey'
+        keys = connection.execute(text(
+            "SELECT conname FROM pg_constraint WHERE conrelid = CAST(:parent AS regclass) AND contype = 'f' "
+            "AND confrelid = CAST('devices' AS regclass)"), {'parent': PARENT}).scalars().all()
+        if foreign_key not in keys:
+            connection.execute(text("ALTER TABLE {0} ADD CONSTRAINT {1} FOREIGN KEY (device_id) REFERENCES devices "
+                                    "(device_id) ON DELETE CASCADE NOT VALID".format(PARENT, foreign_key)))
+        connection.execute(text("ALTER TABLE {0} VALIDATE CONSTRAINT {1}".format(PARENT, foreign_key)))
+        for old_key in set(keys) - {foreign_key}:
+            connection.execute(text("ALTER TABLE {0} DROP CONSTRAINT {1}".format(PARENT, old_key)))
+    with db_engine.begin() as connection:
+        connection.execute(text("SET LOCAL lock_timeout = {0}".format(LOCK_TIMEOUT)))
+        connection.execute(text("LOCK TABLE {0} IN ACCESS EXCLUSIVE MODE".format(PARENT)))
+        connection.execute(text("ALTER TABLE {0} RENAME TO {1}".format(PARENT, partition)))
+        # The partitioned table takes over the index names of the model, and its own primary key
+        for index in table.indexes:
+            if index.name in existing:
+                connection.execute(text("ALTER INDEX {0} RENAME TO {1}".format(index.name, index.name.replace(PARENT, partition))))
+        primary_key = connection.execute(text("SELECT conname FROM pg_constraint WHERE conrelid = CAST(:partition AS regclass) "
+                                              "AND contype = 'p'"), {'partition': partition}).scalar()
+        if primary_key is not None:
+            connection.execute(text("ALTER TABLE {0} DROP CONSTRAINT {1}".format(partition, primary_key)))
+        connection.execute(text("ALTER TABLE {0} ALTER COLUMN date SET NOT NULL".format(partition)))
+        connection.execute(text("ALTER TABLE {0} ADD CONSTRAINT {0}_pkey PRIMARY KEY USING INDEX {0}_pkey".format(partition)))
+        # Same column types as the old table, whichever of models or db_creator made it, and the same sequences
+        connection.execute(text("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE (date)".format(PARENT, partition)))
+        connection.execute(text("ALTER TABLE {0} ALTER COLUMN transaction_id SET DEFAULT {1}".format(
+            PARENT, models.CURRENT_TRANSACTION_ID.text)))
+        for column in ('history_id', 'device_id'):
+            sequence = connection.execute(text("SELECT pg_get_serial_sequence(:partition, :column)"),
+                                          {'partition': partition, 'column': column}).scalar()
+            if sequence is not None:
+                # Or archiving the partition would drop the sequence with it
+                connection.execute(text("ALTER SEQUENCE {0} OWNED BY {1}.{2}".format(sequence, PARENT, column)))
+        connection.execute(text("ALTER TABLE {0} ADD PRIMARY KEY (history_id, date)".format(PARENT)))
+        connection.execute(text("ALTER TABLE {0} ADD FOREIGN KEY (device_id) REFERENCES devices (device_id) ON DELETE CASCADE"
+                                .format(PARENT)))
+        for index in table.indexes:
+            connection.execute(text("CREATE INDEX {0} ON {1} ({2})".format(
+                index.name, PARENT, ", ".join(column.name for column in index.columns))))
+        connection.execute(text("ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM (MINVALUE) TO ('{2}')".format(
+            PARENT, partition, bound)))
+        connection.execute(text("ALTER TABLE {0} DROP CONSTRAINT {1}".format(partition, check)))
+        for command in partition_commands(bound, add_months(month, MONTHS_AHEAD)):
+            connection.execute(text(command))
+    return True
+
+
+def archive_partitions(db_engine, today=None, retention_months=None, archive_dir=None):
+    # Partitions whose whole month lies before the retention window are written to <archive_dir>/<name>.csv.gz,
+    # then detached and dropped. One partition at a time: the export runs without locking device_histories, only
+    # the DETACH and DROP after it do, in a short transaction of their own. A failed export leaves the partition
+    # attached
+    retention_months = RETENTION_MONTHS if retention_months is None else retention_months
+    archive_dir = archive_dir or ARCHIVE_DIR
+    if retention_months <= 0:
+        return []
+    cutoff = add_months((today or date.today()).replace(day=1), -retention_months)
+    archived = []
+    with db_engine.connect() as connection:
+        with connection.begin():
+            # A session lock, held across the transactions below; another process archiving means nothing to do
+            if not connection.execute(text("SELECT pg_try_advisory_lock(:key)"), {'key': ARCHIVE_LOCK}).scalar():
+                return []
+            expired = [name for month, name in list_partitions(connection) if add_months(month, 1) <= cutoff]
+        try:
+            if expired:
+                os.makedirs(archive_dir, exist_ok=True)
+            for name in expired:
+                path = os.path.join(archive_dir, name + '.csv.gz')
+                with connection.begin():
+                    cursor = connection.connection.cursor()
+                    with gzip.open(path, 'wt', encoding='utf-8') as archive:
+                        cursor.copy_expert("COPY {0} TO STDOUT WITH (FORMAT csv, HEADER)".format(name), archive)
+                    cursor.close()
+                try:
+                    with connection.begin():
+                        connection.execute(text("SET LOCAL lock_timeout = {0}".format(LOCK_TIMEOUT)))
+                        connection.execute(text("ALTER TABLE {0} DETACH PARTITION {1}".format(PARENT, name)))
+                        connection.execute(text("DROP TABLE {0}".format(name)))
+                except exc.OperationalError as error:
+                    if getattr(error.orig, 'pgcode', None) != errorcodes.LOCK_NOT_AVAILABLE:
+                        raise
+                    logger.warning("Device history partition %s not detached, %s is busy; retrying on the next run",
+                                   name, PARENT)
+                    break
+                archived.append(path)
+        finally:
+            with connection.begin():
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': ARCHIVE_LOCK})
+    return archived
+
+
+def maintain_partitions(db_engine):
+    ensure_partitions(db_engine)
+    for path in archive_partitions(db_engine):
+        logger.info("Archived device history partition to %s", path)
+
+
+def start_maintenance(db_engine):
+    # Daemon thread repeating the maintenance every MAINTENANCE_INTERVAL seconds
+    def run():
+        while True:
+            time.sleep(MAINTENANCE_INTERVAL)
+            try:
+                maintain_partitions(db_engine)
+            except Exception:
+                logger.exception("Device history partition maintenance failed")
+    thread = threading.Thread(target=run, name="history-partitions", daemon=True)
+    thread.start()
+    return thread
@@ -1,5 +1,5 @@
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field, conint, constr
+from typing import Dict, Optional, List
 from datetime import date, datetime
 
 
@@ -50,6 +50,8 @@ class DevicesSchema(BaseModel):
     date_added: date
     qr_code: str
     returned: bool
+    # Set by the server; a PUT carrying it only applies to that version of the device
+    version: Optional[int] = None
 
     class Config:
         orm_mode = True
@@ -74,3 +76,87 @@ class DeviceHistoriesSchema(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class DeviceHistoryEventSchema(BaseModel):
+    history_id: Optional[int] = None
+    event: str
+    device_id: int
+    date: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class CompactDeviceHistoriesSchema(BaseModel):
+    history: List[DeviceHistoryEventSchema]
+    devices: List[DevicesSchema]
+
+
+class DeviceSyncSchema(CompactDeviceHistoriesSchema):
+    # Applied after the devices: a device deleted since the cursor is listed here and no longer in devices
+    deleted: List[int] = []
+    cursor: str
+    has_more: bool
+
+
+# Bounds of the INT and VARCHAR(255) columns, so an import row exceeding them is reported instead of failing the COPY
+Int4 = conint(ge=-2**31, le=2**31 - 1)
+String255 = constr(max_length=255)
+
+
+class DeviceImportSchema(BaseModel):
+    name: String255
+    serial_number: String255 = ""
+    description: constr(max_length=10000) = ""
+    ean: Optional[String255] = None
+    ean_device_id: Optional[Int4] = None
+    location: Optional[String255] = None
+    location_id: Optional[Int4] = None
+    quantity: Int4
+    condition: String255
+    status: String255
+    qr_code: String255
+    returned: bool = False
+
+
+class DeviceImportResultSchema(BaseModel):
+    row: int
+    device_id: Optional[int] = None
+    qr_code: Optional[str] = None
+    error: Optional[str] = None
+
+
+class DeviceImportReportSchema(BaseModel):
+    created: int
+    failed: int
+    results: List[DeviceImportResultSchema]
+
+
+class DeviceDeleteReportSchema(BaseModel):
+    deleted: List[int]
+    not_found: List[int]
+
+
+class ScanSchema(BaseModel):
+    # Untyped codes are looked up as QR codes, serial numbers and EANs
+    codes: List[str] = Field([], max_items=1000)
+    qr_codes: List[str] = Field([], max_items=1000)
+    serial_numbers: List[str] = Field([], max_items=1000)
+    eans: List[str] = Field([], max_items=1000)
+
+
+class ScanMatchSchema(BaseModel):
+    match: str
+    device: Optional[DevicesSchema] = None
+    ean_device: Optional[EANDevicesSchema] = None
+
+
+class ScanResultSchema(BaseModel):
+    results: Dict[str, ScanMatchSchema]
+    misses: List[str]
+
+
+class SearchResultSchema(BaseModel):
+    devices: List[DevicesSchema]
+    ean_devices: List[EANDevicesSchema]
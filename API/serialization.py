@@ -0,0 +1,29 @@
+import json
+from datetime import date, datetime
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    # orjson when it is installed, the standard encoder otherwise; both give the same document
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(Response):
+    # For rows that crud already built as plain dicts: encoded as they are, without response_model validation
+    media_type = "application/json"
+
+    def render(self, content):
+        return dumps(content)
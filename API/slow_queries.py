@@ -0,0 +1,114 @@
+import logging
+import queue
+import re
+import threading
+import time
+from sqlalchemy import event
+from API.metrics import current_route
+
+logger = logging.getLogger(__name__)
+
+# Plans waiting for the explain thread; slow queries arriving while it is full are logged without a plan
+EXPLAIN_QUEUE_SIZE = 16
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "VALUES")
+# SELECTs that lock rows or take locks wait for the locks of the transaction that ran them, and sequence calls
+# survive the rollback; they are not analyzed, i.e. run again
+UNSAFE_TO_ANALYZE = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b|\bpg_(try_)?advisory_|"
+                               r"\b(nextval|setval)\s*\(", re.IGNORECASE)
+
+
+def redact(parameters):
+    # Parameter names and types only, values may be personal data
+    if isinstance(parameters, dict):
+        return {name: redact(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redact(value) for value in parameters]
+    if parameters is None:
+        return None
+    if isinstance(parameters, (str, bytes)):
+        return "<{0}:{1}>".format(type(parameters).__name__, len(parameters))
+    return "<{0}>".format(type(parameters).__name__)
+
+
+class SlowQueryLog:
+    # Logs every statement of an engine slower than threshold milliseconds with its route, redacted parameters
+    # and duration, then its plan from a background thread. SELECTs are explained with ANALYZE, i.e. run again;
+    # writes and locking SELECTs only get the estimated plan. The same statement is explained at most once per explain_interval
+    def __init__(self, db_engine, threshold, explain=True, explain_timeout=10000, explain_interval=300.0):
+        self.engine = db_engine
+        self.threshold = threshold / 1000
+        self.explain = explain
+        self.explain_timeout = explain_timeout
+        self.explain_interval = explain_interval
+        self._queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self._explained = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        event.listen(db_engine, "before_cursor_execute", self._start)
+        event.listen(db_engine, "after_cursor_execute", self._stop)
+        event.listen(db_engine, "handle_error", self._error)
+
+    def _start(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def _stop(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["slow_query_start"].pop()
+        if elapsed < self.threshold:
+            return
+        route = current_route() or "-"
+        logger.warning("Slow query %.1f ms on %s: %s parameters=%s", elapsed * 1000, route, statement,
+                       "<{0} sets>".format(len(parameters)) if executemany else redact(parameters))
+        if self.explain and not executemany and statement.lstrip().upper().startswith(EXPLAINABLE) \
+                and self._due(statement):
+            try:
+                self._queue.put_nowait((statement, parameters, route, elapsed))
+            except queue.Full:
+                return
+            self._ensure_thread()
+
+    def _error(self, exception_context):
+        # A failed statement never reaches after_cursor_execute, its start would be taken for the next one's.
+        # Statements of a connection run one after the other, a start left is the failed statement's
+        starts = exception_context.connection.info.get("slow_query_start") if exception_context.connection else None
+        if starts:
+            starts.pop()
+
+    def _due(self, statement):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(statement, float("-inf")) < self.explain_interval:
+                return False
+            self._explained = {key: at for key, at in self._explained.items() if now - at < self.explain_interval}
+            self._explained[statement] = now
+            return True
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            statement, parameters, route, elapsed = self._queue.get()
+            try:
+                plan = self.plan(statement, parameters)
+            except Exception:
+                logger.exception("EXPLAIN of the slow query on %s failed", route)
+                continue
+            logger.warning("Plan of the %.1f ms query on %s:\n%s", elapsed * 1000, route, plan)
+
+    def plan(self, statement, parameters):
+        # A raw DBAPI connection, so the EXPLAIN itself skips the engine events. Rolled back, so an analyzed
+        # SELECT leaves nothing behind
+        analyze = statement.lstrip().upper().startswith("SELECT") and not UNSAFE_TO_ANALYZE.search(statement)
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if self.explain_timeout:
+                cursor.execute("SET LOCAL statement_timeout = {0}".format(int(self.explain_timeout)))
+            cursor.execute(("EXPLAIN (ANALYZE, BUFFERS) " if analyze else "EXPLAIN ") + statement, parameters)
+            return "\n".join(row[0] for row in cursor.fetchall())
+        finally:
+            connection.rollback()
+            connection.close()
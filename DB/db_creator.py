@@ -1,5 +1,36 @@
+import sys
+from datetime import date
 import psycopg2
 from config import config
+from API.database import engine
+from API.partitions import MONTHS_AHEAD, add_months, partition_commands, partition_existing_table
+
+# (unique, definition) - kept in sync with the Index/index=True declarations in API/models.py
+INDEXES = (
+    (True, "uq_producers_name ON Producers (Name)"),
+    (False, "ix_devices_name ON Devices (Name)"),
+    (True, "uq_devices_serial_number ON Devices (Serial_number) WHERE Serial_number <> ''"),
+    (True, "uq_devices_qr_code ON Devices (QR_code)"),
+    (False, "ix_devices_ean_device_id ON Devices (EAN_Device_id)"),
+    (False, "ix_devices_location_id ON Devices (Location_id)"),
+    (False, "ix_devices_name_device_id ON Devices (coalesce(Name, ''), Device_id)"),
+    (False, "ix_devices_date_added_device_id ON Devices (Date_added, Device_id)"),
+    (False, "ix_devices_status_device_id ON Devices (Status, Device_id)"),
+    (False, "ix_device_histories_device_id_date ON Device_histories (Device_id, Date)"),
+    (False, "ix_device_histories_date ON Device_histories (Date)"),
+    (False, "ix_device_histories_transaction_id_history_id ON Device_histories (Transaction_id, History_id)"),
+    (False, "ix_device_tombstones_transaction_id ON Device_tombstones (Transaction_id)"),
+    (False, "ix_idempotency_keys_created_at ON Idempotency_keys (Created_at)"),
+    (False, "ix_ean_devices_model_trgm ON EAN_Devices USING gin (Model gin_trgm_ops)"),
+    (False, "ix_devices_name_trgm ON Devices USING gin (Name gin_trgm_ops)"),
+    (False, "ix_devices_serial_number_trgm ON Devices USING gin (Serial_number gin_trgm_ops)"),
+    (False, "ix_devices_description_trgm ON Devices USING gin (Description gin_trgm_ops)"),
+)
+
+
+def index_command(unique, definition, concurrently=False):
+    return "CREATE {0}INDEX {1}IF NOT EXISTS {2}".format("UNIQUE " if unique else "",
+                                                       "CONCURRENTLY " if concurrently else "", definition)
 
 def create_database():
     parameters = config('../database.ini')
@@ -18,6 +49,7 @@ def create_database():
 
 def create_tables():
     commands = (
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
         """
         CREATE TABLE Locations (
             Location_id SERIAL PRIMARY KEY,
@@ -58,7 +90,8 @@ def create_tables():
             Status VARCHAR(255) NOT NULL,
             Date_added DATE NOT NULL,
             QR_code VARCHAR(255) NOT NULL,
-            Returned BOOLEAN NOT NULL DEFAULT FALSE
+            Returned BOOLEAN NOT NULL DEFAULT FALSE,
+            Version INT NOT NULL DEFAULT 1
             )
         """,
         # """
@@ -71,14 +104,50 @@ def create_tables():
         # """,
         """
         CREATE TABLE Device_histories (
-            History_id SERIAL PRIMARY KEY,
+            History_id SERIAL,
             Event VARCHAR(255) NOT NULL,
-            Device_id SERIAL REFERENCES Devices(Device_id),
-            Date TIMESTAMP NOT NULL
-            
+            Device_id SERIAL REFERENCES Devices(Device_id) ON DELETE CASCADE,
+            Date TIMESTAMP NOT NULL,
+            Transaction_id BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+            PRIMARY KEY (History_id, Date)
+            ) PARTITION BY RANGE (Date)
+        """,
+        """
+        CREATE TABLE Device_tombstones (
+            Device_id INT PRIMARY KEY,
+            Transaction_id BIGINT NOT NULL DEFAULT pg_current_xact_id()::text::bigint,
+            Date TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """,
+        """
+        CREATE TABLE Stock_levels (
+            Location_id INT NOT NULL,
+            EAN_Device_id INT NOT NULL,
+            Status VARCHAR(255) NOT NULL,
+            Returned BOOLEAN NOT NULL,
+            Devices INT NOT NULL DEFAULT 0,
+            Quantity BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (Location_id, EAN_Device_id, Status, Returned)
+            )
+        """,
+        """
+        CREATE TABLE Table_versions (
+            Table_name VARCHAR(255) PRIMARY KEY,
+            Version BIGINT NOT NULL DEFAULT 0
             )
         """,
-    )
+        """
+        CREATE TABLE Idempotency_keys (
+            Key VARCHAR PRIMARY KEY,
+            Fingerprint VARCHAR NOT NULL,
+            Status_code INT,
+            Content_type VARCHAR,
+            Body BYTEA,
+            Created_at TIMESTAMP NOT NULL DEFAULT now()
+            )
+        """,
+    ) + tuple(partition_commands(date.today().replace(day=1), add_months(date.today().replace(day=1), MONTHS_AHEAD))) \
+      + tuple(index_command(unique, definition) for unique, definition in INDEXES)
     # jako ostatnie w device_histories User_id SERIAL REFERENCES Users(User_id)
 
     connection = None
@@ -97,6 +166,65 @@ def create_tables():
             connection.close()
 
 
+def create_partitioned_index_concurrently(cursor, unique, definition):
+    # CONCURRENTLY doesn't work on a partitioned table. The index is created ON ONLY Device_histories, invalid
+    # until the index of every partition, built concurrently, is attached to it. Partitions created since get
+    # the index with the table, partitions already attached are skipped, so a rerun finishes an interrupted build
+    name, _, columns = definition.partition(" ON Device_histories ")
+    cursor.execute(index_command(unique, "{0} ON ONLY Device_histories {1}".format(name, columns)))
+    cursor.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+                   "WHERE i.inhparent = 'device_histories'::regclass ORDER BY c.relname")
+    partitions = [partition for partition, in cursor.fetchall()]
+    cursor.execute("SELECT x.indrelid::regclass::text FROM pg_inherits i JOIN pg_index x ON x.indexrelid = i.inhrelid "
+                   "WHERE i.inhparent = %s::regclass", (name,))
+    attached = {partition for partition, in cursor.fetchall()}
+    for partition in partitions:
+        if partition in attached:
+            continue
+        partition_index = name.replace("device_histories", partition)
+        try:
+            cursor.execute(index_command(unique, "{0} ON {1} {2}".format(partition_index, partition, columns),
+                                         concurrently=True))
+        except (Exception, psycopg2.DatabaseError) as error:
+            print(error)
+            cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS {0}".format(partition_index))
+            continue
+        cursor.execute("ALTER INDEX {0} ATTACH PARTITION {1}".format(name, partition_index))
+
+
+def create_indexes_concurrently():
+    # Builds the indexes on an existing database without blocking writes. CONCURRENTLY can't run inside
+    # a transaction, and a failed build leaves an INVALID index behind, which is dropped so a rerun retries it
+    connection = None
+    try:
+        parameters = config('../database.ini')
+        connection = psycopg2.connect(**parameters)
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        for unique, definition in INDEXES:
+            if " ON Device_histories " in definition:
+                create_partitioned_index_concurrently(cursor, unique, definition)
+                continue
+            try:
+                cursor.execute(index_command(unique, definition, concurrently=True))
+            except (Exception, psycopg2.DatabaseError) as error:
+                print(error)
+                cursor.execute("DROP INDEX CONCURRENTLY IF EXISTS {0}".format(definition.split()[0]))
+        cursor.close()
+    except (Exception, psycopg2.DatabaseError) as error:
+        print(error)
+    finally:
+        if connection is not None:
+            connection.close()
+
+
 if __name__=='__main__':
-    create_database()
-    create_tables()
+    if sys.argv[1:] == ['indexes']:
+        create_indexes_concurrently()
+    elif sys.argv[1:] == ['partition']:
+        # Databases whose Device_histories predates partitioning, see API/partitions.py
+        print("Converted" if partition_existing_table(engine) else "Device_histories already is partitioned")
+    else:
+        create_database()
+        create_tables()
@@ -0,0 +1,325 @@
+# Load test of the API against the database configured in ../database.ini.
+# Seeds "load-<n>" devices with their history set-based (in process runs, or with --seed), then drives the app with
+# concurrent clients running one of the request mixes below and reports throughput, p50/p99 latency and SQL statements
+# per request (read from the Server-Timing header). Baselines are kept per mix in a JSON file with the settings they
+# were run with; --compare fails on regressions and refuses a baseline run with other ones.
+#
+#   python -m bench.load_test --devices 1000000 --histories 10000000 --seed-only
+#   python -m bench.load_test --mix scan --duration 30 --concurrency 32 --save-baseline
+#   python -m bench.load_test --mix mixed --compare
+#   python -m bench.load_test --mix search --compare
+#   python -m bench.load_test --mix import --devices 1000000 --import-batch 2000 --compare
+#   python -m bench.load_test --mix read --url http://127.0.0.1:8000 --compare
+#   python -m bench.load_test --mix read --url http://127.0.0.1:8000 --seed --devices 10000
+#
+# The models rely on PostgreSQL (partitioned history, arrays, ON CONFLICT), so there is no SQLite mode.
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+import httpx
+from sqlalchemy import text
+from API.database import SessionLocal, engine
+import API.crud as crud
+import API.models as models
+import API.partitions as partitions
+
+PREFIX = 'load-'
+SEED_BATCH = 100_000
+IMPORT_BATCH = 1000
+# Arguments a baseline was run with, runs with other ones don't compare
+BASELINE_SETTINGS = ('devices', 'histories', 'concurrency', 'import_batch')
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+SERVER_TIMING = re.compile(r'desc="(\d+) statements"')
+
+# Relative weights of the operations in each mix
+MIXES = {
+    'scan': {'qr': 70, 'resolve': 20, 'list': 5, 'update': 5},
+    'read': {'list': 50, 'history': 30, 'stock': 20},
+    'search': {'search': 80, 'qr': 20},
+    # Imports against the seeded devices, whose duplicate check looks up every QR code and serial number of a batch
+    'import': {'bulk_import': 100},
+    'write': {'update': 60, 'create_delete': 40},
+    'mixed': {'qr': 40, 'resolve': 10, 'list': 15, 'history': 10, 'stock': 5, 'update': 15, 'create_delete': 5},
+}
+
+
+def reference_ids(db, table, key, count, insert):
+    # Ids of the load test rows of a reference table, created up to count
+    ids = db.execute(text(f"SELECT {key} FROM {table} WHERE name LIKE '{PREFIX}%' ORDER BY {key}")).scalars().all()
+    if len(ids) < count:
+        db.execute(text(insert), {'start': len(ids), 'stop': count})
+        ids = db.execute(text(f"SELECT {key} FROM {table} WHERE name LIKE '{PREFIX}%' ORDER BY {key}")).scalars().all()
+    return ids
+
+
+def seed(db, devices, histories, history_days):
+    # Set-based inserts in batches of SEED_BATCH devices, each batch with its share of history events spread over
+    # the last history_days days. Rerunning only adds what is missing
+    today = date.today()
+    for command in partitions.partition_commands((today - timedelta(days=history_days)).replace(day=1),
+                                                 partitions.add_months(today.replace(day=1), partitions.MONTHS_AHEAD)):
+        db.execute(text(command))
+    locations = reference_ids(db, 'locations', 'location_id', 20, f"INSERT INTO locations (name) "
+                              f"SELECT '{PREFIX}' || n FROM generate_series(:start, :stop - 1) n")
+    categories = reference_ids(db, 'categories', 'category_id', 10, f"INSERT INTO categories (name) "
+                               f"SELECT '{PREFIX}' || n FROM generate_series(:start, :stop - 1) n")
+    producers = reference_ids(db, 'producers', 'producer_id', 20, f"INSERT INTO producers (name) "
+                              f"SELECT '{PREFIX}' || n FROM generate_series(:start, :stop - 1) n")
+    ean_count = max(devices // 100, 1)
+    existing = db.execute(text(f"SELECT count(*) FROM ean_devices WHERE ean LIKE '{PREFIX}%'")).scalar()
+    db.execute(text(f"INSERT INTO ean_devices (ean, model, category_id, producer_id) "
+                    f"SELECT '{PREFIX}' || n, '{PREFIX}model-' || n, "
+                    f"(:categories)[1 + n % cardinality(:categories)], (:producers)[1 + n % cardinality(:producers)] "
+                    f"FROM generate_series(:start, :stop - 1) n"),
+               {'start': existing, 'stop': ean_count, 'categories': categories, 'producers': producers})
+    eans = db.execute(text(f"SELECT ean_device_id FROM ean_devices WHERE ean LIKE '{PREFIX}%' ORDER BY ean_device_id")).scalars().all()
+    db.commit()
+
+    per_device = histories // devices if devices else 0
+    start = db.execute(text(f"SELECT count(*) FROM devices WHERE qr_code LIKE '{PREFIX}%'")).scalar()
+    for batch in range(start, devices, SEED_BATCH):
+        stop = min(batch + SEED_BATCH, devices)
+        db.execute(text(
+            f"WITH new AS (INSERT INTO devices (name, serial_number, description, ean_device_id, location_id, quantity, "
+            f"condition, status, date_added, qr_code, returned) "
+            f"SELECT '{PREFIX}' || n, 'LSN' || n, 'load test device ' || n, (:eans)[1 + n % cardinality(:eans)], "
+            f"(:locations)[1 + n % cardinality(:locations)], 1 + n % 5, (ARRAY['new', 'used', 'broken'])[1 + n % 3], "
+            f"(ARRAY['available', 'reserved', 'sold', 'service'])[1 + n % 4], current_date - n % :days, "
+            f"'{PREFIX}' || n, n % 10 = 0 FROM generate_series(:start, :stop - 1) n RETURNING device_id) "
+            f"INSERT INTO device_histories (event, device_id, date) "
+            f"SELECT 'load test event', new.device_id, now() - random() * :days * interval '1 day' "
+            f"FROM new CROSS JOIN generate_series(1, :per_device)"),
+            {'start': batch, 'stop': stop, 'eans': eans, 'locations': locations, 'days': history_days,
+             'per_device': per_device})
+        crud.bump_table_versions(db, ['locations', 'categories', 'producers', 'ean_devices', 'devices', 'device_histories'])
+        db.commit()
+        print(f"seeded devices {stop}/{devices}", file=sys.stderr)
+    crud.rebuild_stock_levels(db)
+    db.execute(text("ANALYZE"))
+    db.commit()
+
+
+class Client:
+    # One simulated user: picks operations by weight and records (operation, seconds, statements, ok) samples
+    def __init__(self, http, mix, devices, rng, samples, import_batch=IMPORT_BATCH):
+        self.http = http
+        self.import_batch = import_batch
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.devices = devices
+        self.rng = rng
+        self.samples = samples
+        self.template = None
+
+    def qr_code(self):
+        return f"{PREFIX}{self.rng.randrange(self.devices)}"
+
+    async def request(self, operation, method, url, **kwargs):
+        start = time.perf_counter()
+        response = await self.http.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+        match = SERVER_TIMING.search(response.headers.get('server-timing', ''))
+        self.samples.append((operation, elapsed, int(match.group(1)) if match else None, response.status_code < 400))
+        return response
+
+    async def qr(self):
+        return await self.request('qr', 'GET', f"/devices/qr/{self.qr_code()}")
+
+    async def resolve(self):
+        await self.request('resolve', 'POST', "/scan/resolve", json={'codes': [self.qr_code() for _ in range(20)]})
+
+    async def list(self):
+        await self.request('list', 'GET', "/devices/", params={'limit': 100, 'sort': '-date_added'})
+
+    async def history(self):
+        await self.request('history', 'GET', f"/deviceshistories/{self.qr_code()}", params={'limit': 50})
+
+    async def search(self):
+        # Partial serial numbers and model names, as typed into the search box
+        n = str(self.rng.randrange(self.devices))
+        q = self.rng.choice([f"LSN{n[:4]}", f"model-{n[:3]}", f"device {n}"])
+        await self.request('search', 'GET', "/search/", params={'q': q, 'limit': 20})
+
+    async def stock(self):
+        await self.request('stock', 'GET', "/stock/", params={'group_by': 'location,status'})
+
+    async def update(self):
+        response = await self.qr()
+        if response.status_code != 200:
+            return
+        device = response.json()
+        device['quantity'] = device['quantity'] % 5 + 1
+        device['status'] = self.rng.choice(['available', 'reserved', 'sold', 'service'])
+        await self.request('update', 'PUT', f"/devices/id/{device['device_id']}", json=device)
+
+    async def create_delete(self):
+        if self.template is None:
+            response = await self.qr()
+            if response.status_code != 200:
+                return
+            self.template = response.json()
+        code = f"loadtmp-{uuid.uuid4().hex}"
+        device = dict(self.template, device_id=None, name=code, serial_number=code, qr_code=code)
+        response = await self.request('create', 'POST', "/devices/id", json=device)
+        if response.status_code == 201:
+            await self.request('delete', 'DELETE', f"/devices/id/{response.json()['device_id']}")
+
+    async def bulk_import(self):
+        # A batch of new devices, removed again so the table keeps its seeded size
+        code = f"loadtmp-{uuid.uuid4().hex}-"
+        rows = [{'name': f"{code}{i}", 'serial_number': f"{code}{i}", 'qr_code': f"{code}{i}", 'ean': f"{PREFIX}0",
+                 'location': f"{PREFIX}0", 'quantity': 1, 'condition': 'new', 'status': 'available'}
+                for i in range(self.import_batch)]
+        response = await self.request('bulk_import', 'POST', "/devices/bulk", json=rows)
+        if response.status_code == 200:
+            created = [result['device_id'] for result in response.json()['results'] if result['device_id'] is not None]
+            await self.request('bulk_delete', 'POST', "/devices/bulk/delete", json=created)
+
+    async def run(self, deadline):
+        while time.perf_counter() < deadline:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            await getattr(self, operation)()
+
+
+async def drive(args, devices):
+    if args.url:
+        http = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        # In process: the app with its startup hooks, without a network hop
+        from API.inventory_api import app
+        await app.router.startup()
+        http = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench', timeout=60)
+    async with http:
+        for warmup in (True, False):
+            samples = []
+            seconds = args.warmup if warmup else args.duration
+            deadline = time.perf_counter() + seconds
+            clients = [Client(http, MIXES[args.mix], devices, random.Random(args.random_seed + i), samples,
+                              args.import_batch) for i in range(args.concurrency)]
+            start = time.perf_counter()
+            await asyncio.gather(*(client.run(deadline) for client in clients))
+            elapsed = time.perf_counter() - start
+    return samples, elapsed
+
+
+def percentile(values, fraction):
+    # Nearest rank on sorted values
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    groups = {}
+    for operation, seconds, statements, ok in samples:
+        groups.setdefault(operation, []).append((seconds, statements, ok))
+    groups['all'] = [(seconds, statements, ok) for _, seconds, statements, ok in samples]
+    summary = {}
+    for operation, rows in groups.items():
+        latencies = sorted(seconds for seconds, _, _ in rows)
+        statements = [count for _, count, _ in rows if count is not None]
+        summary[operation] = {
+            'requests': len(rows), 'errors': sum(not ok for _, _, ok in rows), 'rps': len(rows) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000, 'p99_ms': percentile(latencies, 0.99) * 1000,
+            'statements': sum(statements) / len(statements) if statements else None}
+    return summary
+
+
+def print_summary(summary):
+    print(f"{'operation':<12}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'SQL/req':>9}")
+    for operation, row in sorted(summary.items(), key=lambda item: item[0] == 'all'):
+        statements = '-' if row['statements'] is None else f"{row['statements']:.1f}"
+        print(f"{operation:<12}{row['requests']:>10}{row['errors']:>8}{row['rps']:>10.1f}{row['p50_ms']:>10.1f}"
+              f"{row['p99_ms']:>10.1f}{statements:>9}")
+
+
+def regressions(summary, baseline, tolerance):
+    # Latency and throughput may drift by tolerance, statement counts are deterministic and may not grow
+    found = []
+    for operation, base in baseline.items():
+        row = summary.get(operation)
+        if row is None:
+            continue
+        if row['p99_ms'] > base['p99_ms'] * (1 + tolerance):
+            found.append(f"{operation}: p99 {row['p99_ms']:.1f} ms, baseline {base['p99_ms']:.1f} ms")
+        if row['rps'] < base['rps'] * (1 - tolerance):
+            found.append(f"{operation}: {row['rps']:.1f} req/s, baseline {base['rps']:.1f} req/s")
+        if row['statements'] is not None and base['statements'] is not None and row['statements'] > base['statements'] + 0.5:
+            found.append(f"{operation}: {row['statements']:.1f} statements per request, baseline {base['statements']:.1f}")
+        if row['errors'] > base['errors']:
+            found.append(f"{operation}: {row['errors']} errors, baseline {base['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="API load test")
+    parser.add_argument('--devices', type=int, default=100_000, help="seeded devices")
+    parser.add_argument('--histories', type=int, default=1_000_000, help="seeded history events, spread evenly over the devices")
+    parser.add_argument('--history-days', type=int, default=90, help="seeded events are dated within this many past days")
+    parser.add_argument('--seed', action='store_true', help="seed before driving a --url server too")
+    parser.add_argument('--seed-only', action='store_true', help="seed and exit")
+    parser.add_argument('--mix', choices=sorted(MIXES), default='mixed')
+    parser.add_argument('--concurrency', type=int, default=16, help="simulated clients")
+    parser.add_argument('--duration', type=float, default=30.0, help="measured seconds")
+    parser.add_argument('--warmup', type=float, default=5.0, help="unmeasured seconds before the measurement")
+    parser.add_argument('--import-batch', type=int, default=IMPORT_BATCH, help="devices per request of the import mix")
+    parser.add_argument('--random-seed', type=int, default=0, help="seed of the clients' random choices")
+    parser.add_argument('--url', help="drive a running server instead of the app in process")
+    parser.add_argument('--baselines', default=BASELINES, help="baseline file, one entry per mix")
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the mix's baseline")
+    parser.add_argument('--compare', action='store_true', help="exit with 1 when this run regresses against the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed relative latency and throughput drift")
+    args = parser.parse_args()
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+    baseline = baselines.get(args.mix)
+    if args.compare and baseline is not None:
+        # Numbers of another data size or client count don't compare, check before spending the run
+        differing = [f"--{key.replace('_', '-')} {baseline.get(key)}" for key in BASELINE_SETTINGS
+                     if baseline.get(key) != getattr(args, key)]
+        if differing:
+            parser.error(f"the baseline of mix {args.mix} was run with {', '.join(differing)}")
+
+    # A --url server may run against another database than ../database.ini, it is only seeded on request
+    if args.seed or args.seed_only or not args.url:
+        models.Base.metadata.create_all(bind=engine)
+        db = SessionLocal()
+        try:
+            seed(db, args.devices, args.histories, args.history_days)
+        finally:
+            db.close()
+    if args.seed_only:
+        return
+
+    samples, elapsed = asyncio.run(drive(args, args.devices))
+    summary = summarize(samples, elapsed)
+    print(f"mix {args.mix}, {args.concurrency} clients, {elapsed:.1f} s, {args.devices} devices")
+    print_summary(summary)
+    if 'bulk_import' in summary:
+        print(f"imported {summary['bulk_import']['rps'] * args.import_batch:.0f} devices/s")
+
+    failed = []
+    if args.compare:
+        if baseline is None:
+            print(f"no baseline for mix {args.mix} in {args.baselines}")
+        else:
+            failed = regressions(summary, baseline['operations'], args.tolerance)
+            print("\n".join(["regressions:"] + failed) if failed else "no regressions")
+    if args.save_baseline:
+        baselines[args.mix] = dict({key: getattr(args, key) for key in BASELINE_SETTINGS}, operations=summary)
+        with open(args.baselines, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+# Compares the list serialization paths on the database configured in ../database.ini:
+# ORM objects validated by the orm_mode schemas and encoded by the standard json module (what the routes did),
+# against rows built from SQL tuples and encoded by API.serialization.dumps.
+#
+#   python -m bench.serialization --seed 50000
+#   python -m bench.serialization --repeat 5
+import argparse
+import json
+import time
+from fastapi.encoders import jsonable_encoder
+from API.database import SessionLocal, engine
+from API.serialization import dumps, orjson
+import API.crud as crud
+import API.models as models
+import API.schemas as schemas
+
+
+def seed(db, count):
+    location = crud.get_location_ref(db, name='bench') or crud.create_location(db, schemas.LocationsSchema(name='bench'))
+    ean_device = crud.get_ean_device_ref(db, ean='bench')
+    if ean_device is None:
+        category = crud.get_category_ref(db, name='bench') or crud.create_category(db, schemas.CategoriesSchema(name='bench'))
+        producer = crud.get_producer_ref(db, name='bench') or crud.create_producer(db, schemas.ProducersSchema(name='bench'))
+        ean_device = crud.create_ean_device_by_name(db, schemas.EANDevicesSchema(ean='bench', model='bench', category=category,
+                                                                                  producer=producer))
+    start = db.query(models.Devices).count()
+    rows = [{'name': f'bench-{i}', 'ean_device_id': ean_device.ean_device_id, 'location_id': location.location_id,
+             'quantity': 1, 'condition': 'new', 'status': 'available', 'qr_code': f'bench-{i}'}
+            for i in range(start, start + count)]
+    # The import writes the creation event of every device, one history event each
+    report = crud.create_devices_bulk(db, rows)
+    print(f"seeded {report.created} devices")
+
+
+def legacy_devices(db):
+    devices = db.query(models.Devices).options(*crud.DEVICE_LOAD).order_by(models.Devices.device_id).all()
+    return json.dumps(jsonable_encoder([schemas.DevicesSchema.from_orm(device) for device in devices])).encode("utf-8")
+
+
+def fast_devices(db):
+    return dumps(crud.get_devices(db))
+
+
+def legacy_histories(db):
+    histories = crud.get_devices_histories(db, expand=True)
+    return json.dumps(jsonable_encoder([schemas.DeviceHistoriesSchema.from_orm(history) for history in histories])).encode("utf-8")
+
+
+def fast_histories(db):
+    return dumps(crud.compact_device_histories(db, crud.get_devices_histories(db, expand=False)))
+
+
+def measure(run, repeat):
+    best, size = None, 0
+    for _ in range(repeat):
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            size = len(run(db))
+            elapsed = time.perf_counter() - start
+        finally:
+            db.close()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List serialization benchmark")
+    parser.add_argument('--seed', type=int, default=0, help="add this many devices (and one history event each) first")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per path, the best one is reported")
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(bind=engine)
+    if args.seed:
+        db = SessionLocal()
+        try:
+            seed(db, args.seed)
+        finally:
+            db.close()
+
+    print(f"encoder: {'orjson' if orjson is not None else 'json'}")
+    for route, legacy, fast in (('/devices/', legacy_devices, fast_devices),
+                                ('/deviceshistories/', legacy_histories, fast_histories)):
+        legacy_time, legacy_size = measure(legacy, args.repeat)
+        fast_time, fast_size = measure(fast, args.repeat)
+        print(f"{route:<20} legacy {legacy_time * 1000:8.1f} ms {legacy_size:>10} B   "
+              f"fast {fast_time * 1000:8.1f} ms {fast_size:>10} B   x{legacy_time / fast_time:.1f}")
+
+
+if __name__ == '__main__':
+    main()